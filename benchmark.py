@@ -0,0 +1,672 @@
+"""
+Benchmarks locales del corrector.
+
+Uso:
+    python benchmark.py backends [-n 50]
+    python benchmark.py plantilla [-n 20] [-j 1] [--combinator] [--escenario NOMBRE] [--json FICHERO]
+    python benchmark.py libreria [-n 200] [--referencia libreria_antigua.py] [--json FICHERO]
+    python benchmark.py trazas traza.jsonl [...]
+    python benchmark.py barajado [--mb 1 10 100] [--json FICHERO]
+    python benchmark.py regresiones [--backend fork subprocess]
+"""
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+import random, tracemalloc, importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import plantilla
+import libreria
+from comun import RAIZ, evaluar_con_pipeline, percentil, renderizar_plantilla
+
+PROGRAMAS = {
+    "vacío": "",
+    "print": "print(input())",
+    "imports": "import math, random, collections, itertools\nprint(math.sqrt(int(input())))",
+}
+
+
+def resumen(nombre, tiempos, extra=""):
+    ms = [t * 1000 for t in tiempos]
+    print(
+        f"{nombre:<28} media {statistics.mean(ms):7.2f} ms"
+        f"  p50 {percentil(ms, 50):7.2f}  p95 {percentil(ms, 95):7.2f}"
+        f"  p99 {percentil(ms, 99):7.2f}{extra}"
+    )
+    return {
+        "media_ms": statistics.mean(ms),
+        "p50_ms": percentil(ms, 50),
+        "p95_ms": percentil(ms, 95),
+        "p99_ms": percentil(ms, 99),
+    }
+
+
+def guardar_json(ruta, datos):
+    if ruta:
+        with open(ruta, "w", encoding="utf8") as f:
+            json.dump(datos, f, indent=2, ensure_ascii=False)
+
+
+# ╔════════════ LATENCIA POR EJECUCIÓN (run_py) ════════════════╗
+
+def bench_backends(args):
+    """
+    Compara la latencia de run_py con el backend subprocess (un intérprete
+    por ejecución) y con el servidor fork precalentado.
+    """
+    backends = [b for b in ("subprocess", "fork") if b != "fork" or hasattr(os, "fork")]
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        for nombre_prog, code in PROGRAMAS.items():
+            for backend in backends:
+                plantilla.BACKEND = backend
+                plantilla.run_py(code, "9\n")  # calentamiento
+                tiempos = []
+                for _ in range(args.n):
+                    t0 = time.perf_counter()
+                    plantilla.run_py(code, "9\n")
+                    tiempos.append(time.perf_counter() - t0)
+                resumen(f"{nombre_prog} [{backend}]", tiempos)
+
+
+# ╔════════════ PLANTILLA COMPLETA (plantilla.py renderizada) ═══╗
+
+def _csv_grande(filas, columnas=8, seed=0):
+    rnd = random.Random(seed)
+    return "".join(
+        ",".join(str(rnd.randint(0, 99999)) for _ in range(columnas)) + "\n"
+        for _ in range(filas)
+    )
+
+
+_SUMA_CSV = (
+    "total = 0\n"
+    "with open('datos.csv') as f:\n"
+    "    for linea in f:\n"
+    "        total += int(linea.split(',')[0])\n"
+    "print(total)\n"
+)
+
+# Cada escenario: respuesta del patrón, respuesta del alumno, tests (stdin,
+# testcode, extra), adjuntos {nombre: contenido}, cuántas veces menos se
+# repite (para los que agotan el tiempo) y si todos los envíos son el mismo
+# código (para la caché de veredictos)
+ESCENARIOS = {
+    "correcto": {
+        "patron": "n = int(input())\nprint(n * 2)\n",
+        "alumno": "n = int(input())\nprint(2 * n)\n",
+        "tests": [(f"{i}\n", "", "") for i in range(5)],
+    },
+    "duplicados": {
+        "patron": "n = int(input())\nprint(n * 2)\n",
+        "alumno": "n = int(input())\nprint(2 * n)\n",
+        "tests": [(f"{i}\n", "", "") for i in range(5)],
+        "duplicado": True,
+    },
+    "salida_incorrecta": {
+        "patron": "n = int(input())\nprint(n * 2)\n",
+        "alumno": "n = int(input())\nprint(n + 2)\n",
+        "tests": [(f"{i}\n", "", "") for i in range(5)],
+    },
+    "bucle_infinito": {
+        "patron": "n = int(input())\nprint(n * 2)\n",
+        "alumno": "n = int(input())\nwhile True:\n    n += 1\n",
+        "tests": [("1\n", "", "")],
+        "divisor": 10,
+    },
+    "salida_enorme": {
+        "patron": "print('hola')\n",
+        "alumno": "while True:\n    print('hola' * 100)\n",
+        "tests": [("", "", "")],
+        "divisor": 4,
+    },
+    "csv_grande": {
+        "patron": _SUMA_CSV,
+        "alumno": _SUMA_CSV,
+        "tests": [("", "", ""), ("\n", "", "")],
+        "adjuntos": {"datos.csv": _csv_grande(50_000)},
+    },
+    "imports_pesados": {
+        "patron": "import decimal, fractions, statistics, json, csv, datetime\nprint(statistics.mean([1, 2, 3]))\n",
+        "alumno": "import decimal, fractions, statistics, json, csv, datetime, email, http.client, xml.dom.minidom\n"
+                  "print(statistics.mean([1, 2, 3]))\n",
+        "tests": [("", "", "")],
+    },
+}
+
+
+def _ejecutar_corrector(directorio, timeout=120):
+    """
+    Ejecuta prog.py (la plantilla renderizada) en "directorio".
+    Devuelve (segundos, pico de memoria en bytes, salida).
+    """
+    t0 = time.perf_counter()
+    p = subprocess.Popen(
+        [sys.executable, "prog.py"], cwd=directorio,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+    )
+    salida = p.stdout.read()
+    p.stdout.close()
+    _, status, uso = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    rss = uso.ru_maxrss if sys.platform == "darwin" else uso.ru_maxrss * 1024
+    return time.perf_counter() - t0, rss, salida
+
+
+def _envio(escenario, i, combinator):
+    """
+    Prepara y corrige un envío del escenario. En modo combinator la plantilla
+    se ejecuta una vez con todos los tests; si no, una vez por test.
+    """
+    alumno = escenario["alumno"] + ("" if escenario.get("duplicado") else f"# envío {i}\n")
+    tests = [{"stdin": a, "testcode": b, "extra": c} for a, b, c in escenario["tests"]]
+    adjuntos = escenario.get("adjuntos", {})
+    base = {
+        "ATTACHMENTS": ",".join(adjuntos),
+        "STUDENT_ANSWER": alumno,
+        "QUESTION.answer": escenario["patron"],
+    }
+    if combinator:
+        lotes = [(dict(base, TESTCASES=tests), "do_testing_combinator()")]
+    else:
+        lotes = [
+            (dict(base, **{"TEST.stdin": t["stdin"], "TEST.testcode": t["testcode"], "TEST.extra": t["extra"]}),
+             "do_testing()")
+            for t in tests
+        ]
+
+    total, pico = 0.0, 0
+    with tempfile.TemporaryDirectory() as d:
+        for valores, llamada in lotes:
+            for nombre, contenido in adjuntos.items():
+                with open(os.path.join(d, nombre), "w", encoding="utf8") as f:
+                    f.write(contenido)
+            with open(os.path.join(d, "prog.py"), "w", encoding="utf8") as f:
+                f.write(renderizar_plantilla(valores, llamada))
+            segundos, rss, _ = _ejecutar_corrector(d)
+            total += segundos
+            pico = max(pico, rss)
+    return total, pico
+
+
+def bench_plantilla(args):
+    """
+    Corrige un corpus sintético de envíos con la plantilla renderizada y
+    mide envíos por segundo, latencia por envío y pico de memoria.
+    """
+    resultados = {}
+    nombres = args.escenario or list(ESCENARIOS)
+    for nombre in nombres:
+        escenario = ESCENARIOS[nombre]
+        n = max(1, args.n // escenario.get("divisor", 1))
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.j) as pool:
+            medidas = list(pool.map(lambda i: _envio(escenario, i, args.combinator), range(n)))
+        pared = time.perf_counter() - t0
+        tiempos = [m[0] for m in medidas]
+        pico = max(m[1] for m in medidas)
+        r = resumen(nombre, tiempos, f"  {n / pared:6.2f} env/s  pico {pico / 2**20:6.1f} MiB")
+        r.update({"envios": n, "envios_por_segundo": n / pared, "pico_bytes": pico})
+        resultados[nombre] = r
+    guardar_json(args.json, {"plantilla": resultados, "combinator": args.combinator, "j": args.j})
+
+
+# ╔════════════ PIPELINE EN PROCESO (libreria.py) ═════════════╗
+
+CASOS_LIBRERIA = {
+    "programa_correcto": {
+        "parametros": {"tipo": "programa", "entrada_estandar": {"generador": "lista_enteros", "cantidad": 50}},
+        "patron": "print(sum(int(x) for x in input().split()))\n",
+        "alumno": "print(sum(map(int, input().split())))\n",
+    },
+    "programa_ficheros": {
+        "parametros": {
+            "tipo": "programa",
+            "entrada_estandar": {"generador": "entero"},
+            "ficheros_entrada": [{"nombre": "entrada.txt", "generador": "lista_enteros", "cantidad": 2000, "separador": "linea"}],
+            "ficheros_salida": [{"nombre": "salida.txt"}],
+        },
+        "patron": "n = int(input())\nnums = open('entrada.txt').read().split()\n"
+                  "open('salida.txt', 'w').write(str(sum(map(int, nums)) * n))\nprint(len(nums))\n",
+        "alumno": "n = int(input())\nnums = open('entrada.txt').read().split()\n"
+                  "open('salida.txt', 'w').write(str(sum(map(int, nums)) * n))\nprint(len(nums))\n",
+    },
+    "funcion": {
+        "parametros": {"tipo": "funcion", "argumentos": [{"generador": "entero"}, {"generador": "entero"}]},
+        "patron": "def sol_patron(a, b):\n    return a * b\n",
+        "alumno": "def resolver(a, b):\n    return b * a\n",
+    },
+    "funcion_casos": {
+        "parametros": {
+            "tipo": "funcion", "casos": 200, "tiempo_por_llamada": 1,
+            "argumentos": [{"generador": "entero", "max": 20}, {"generador": "lista_enteros", "cantidad": 20}],
+        },
+        "patron": "def sol_patron(n, lista):\n    return sorted(x * n for x in lista)\n",
+        "alumno": "def resolver(n, lista):\n    return sorted([n * x for x in lista])\n",
+    },
+}
+
+
+def evaluar_con_libreria(caso, lib=libreria):
+    """
+    Reproduce lo que hace la plantilla de pregunta que usa libreria.py,
+    etapa a etapa y reasignando CONTEXTO (vale para cualquier versión de
+    libreria.py).
+    """
+    params = json.dumps(caso["parametros"])
+    contexto = lib.cargar_parametros({}, params)
+    contexto = lib.comprobar_restricciones(contexto, caso["alumno"])
+    if contexto.get("bloquear_ejecucion"):
+        return contexto
+    contexto = lib.preparar_contexto(contexto)
+
+    if contexto["tipo"] == "funcion":
+        gbls = {}
+        exec(caso["patron"], gbls)
+        exec(caso["alumno"], gbls)
+        contexto = lib.evaluar_funciones(contexto, gbls)
+    else:
+        stdin = sys.stdin
+        try:
+            contexto = lib.preparar_entorno_patron(contexto)
+            exec(caso["patron"], {})
+            contexto = lib.finalizar_entorno_patron(contexto)
+            contexto = lib.preparar_entorno_alumno(contexto)
+            exec(caso["alumno"], {})
+            contexto = lib.finalizar_entorno_alumno(contexto)
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stdin = stdin
+        contexto = lib.evaluar_programas(contexto)
+    return lib.construir_resultado(contexto)
+
+
+def _cargar_libreria(ruta):
+    spec = importlib.util.spec_from_file_location("libreria_referencia", ruta)
+    modulo = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(modulo)
+    return modulo
+
+
+def _bench_libreria_hilos(nombre, caso, n, j):
+    def evaluar(_):
+        t = time.perf_counter()
+        contexto = evaluar_con_pipeline(caso, directorio_propio=True)
+        return time.perf_counter() - t, contexto.get("award")
+
+    with ThreadPoolExecutor(max_workers=j) as pool:
+        t0 = time.perf_counter()
+        medidas = list(pool.map(evaluar, range(n)))
+        pared = time.perf_counter() - t0
+    notas = {nota for _, nota in medidas}
+    r = resumen(
+        f"{nombre} [hilos x{j}]", [t for t, _ in medidas],
+        f"  {n / pared:8.1f} ev/s  notas {sorted(notas)}"
+    )
+    r.update({"evaluaciones_por_segundo": n / pared, "hilos": j, "notas": sorted(notas)})
+    return r
+
+
+def bench_libreria(args):
+    """
+    Mide evaluaciones por segundo, latencia y pico de memoria (tracemalloc)
+    del pipeline en proceso de libreria.py: etapa a etapa como una plantilla
+    ("plantilla"), con el pipeline ("pipeline") y, con --referencia, etapa a
+    etapa con otra versión de libreria.py (p. ej. la anterior al Contexto).
+    Con -j N también mide el pipeline con N hilos a la vez ("hilos") y
+    comprueba que todas las evaluaciones dan la misma nota.
+    """
+    modos = {
+        "plantilla": evaluar_con_libreria,
+        "pipeline": evaluar_con_pipeline,
+    }
+    if args.referencia:
+        referencia = _cargar_libreria(os.path.abspath(args.referencia))
+        modos["referencia"] = lambda caso: evaluar_con_libreria(caso, referencia)
+
+    resultados = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for nombre, caso in CASOS_LIBRERIA.items():
+                for modo, evaluar in modos.items():
+                    evaluar(caso)  # calentamiento
+                    tiempos = []
+                    tracemalloc.start()
+                    t0 = time.perf_counter()
+                    for _ in range(args.n):
+                        t = time.perf_counter()
+                        evaluar(caso)
+                        tiempos.append(time.perf_counter() - t)
+                    pared = time.perf_counter() - t0
+                    _, pico = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    r = resumen(
+                        f"{nombre} [{modo}]", tiempos,
+                        f"  {args.n / pared:8.1f} ev/s  pico {pico / 2**10:8.1f} KiB"
+                    )
+                    r.update({"evaluaciones_por_segundo": args.n / pared, "pico_bytes": pico})
+                    resultados[f"{nombre}/{modo}"] = r
+                if args.j > 1:
+                    resultados[f"{nombre}/hilos"] = _bench_libreria_hilos(nombre, caso, args.n, args.j)
+        finally:
+            os.chdir(cwd)
+    guardar_json(args.json, {"libreria": resultados})
+
+
+# ╔════════════ BARAJADO DE ADJUNTOS GRANDES ═══════════╗
+
+# Versión anterior de barajar_fichero (listas de filas y columnas), para
+# comparar memoria y comprobar que el resultado es el mismo byte a byte
+BARAJAR_ANTERIOR = """
+import random
+def barajar_fichero(entrada, salida=None, seed=None):
+    if seed is not None:
+        random.seed(seed)
+    with open(entrada, "r", encoding="utf8", errors="replace") as f:
+        filas = [ln.rstrip().rstrip("\\n") for ln in f]
+    while filas and filas[-1] == "":
+        filas.pop()
+    datos = [fila.split(",") for fila in filas if fila != ""]
+    if not datos:
+        if salida is None:
+            salida = entrada + "_barajado"
+        open(salida, "w").close()
+        return salida
+    maxc = max(len(r) for r in datos)
+    for r in datos:
+        r.extend([""] * (maxc - len(r)))
+    columnas = list(zip(*datos))
+    columnas_barajadas = []
+    for col in columnas:
+        col = list(col)
+        random.shuffle(col)
+        columnas_barajadas.append(col)
+    filas_out = list(zip(*columnas_barajadas))
+    if salida is None:
+        salida = entrada
+    with open(salida, "w", encoding="utf8") as g:
+        for r in filas_out:
+            g.write(",".join(r) + "\\n")
+    return salida
+"""
+
+# El pico se lee de VmHWM en el propio hijo: ru_maxrss lo arrastra del
+# fork (el RSS del benchmark copiado) aunque después haga exec
+_MEDIR_BARAJADO = (
+    "import sys, time\n"
+    "exec(sys.argv[1])\n"
+    "t = time.perf_counter()\n"
+    "barajar_fichero(sys.argv[2], sys.argv[3], 12345)\n"
+    "print(time.perf_counter() - t)\n"
+    "try:\n"
+    "    with open('/proc/self/status') as f:\n"
+    "        print(next(int(l.split()[1]) * 1024 for l in f if l.startswith('VmHWM:')))\n"
+    "except OSError:\n"
+    "    import resource\n"
+    "    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+    "    print(rss if sys.platform == 'darwin' else rss * 1024)\n"
+)
+
+
+def _medir_barajado(fuente, entrada, salida):
+    """
+    Baraja "entrada" en un intérprete nuevo con el barajar_fichero de
+    "fuente". Devuelve (segundos, pico de memoria del proceso en bytes).
+    """
+    p = subprocess.run(
+        [sys.executable, "-c", _MEDIR_BARAJADO, fuente, entrada, salida],
+        stdout=subprocess.PIPE, text=True
+    )
+    if p.returncode != 0:
+        raise RuntimeError("barajar_fichero falló")
+    segundos, rss = p.stdout.split()
+    return float(segundos), int(rss)
+
+
+def bench_barajado(args):
+    """
+    Compara tiempo y pico de memoria de barajar_fichero frente a la versión
+    anterior con CSV de varios tamaños, y comprueba que ambas generan el
+    mismo fichero para la misma semilla.
+    """
+    implementaciones = {"anterior": BARAJAR_ANTERIOR, "actual": plantilla.PRELUDIO_SRC}
+    resultados = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        entrada = os.path.join(tmp, "datos.csv")
+        for mb in args.mb:
+            bloque = _csv_grande(20000)
+            with open(entrada, "w", encoding="utf8") as f:
+                for _ in range(max(1, round(mb * 2**20 / len(bloque)))):
+                    f.write(bloque)
+            tam = os.path.getsize(entrada)
+            salidas = {}
+            for nombre, fuente in implementaciones.items():
+                salidas[nombre] = os.path.join(tmp, nombre + ".csv")
+                segundos, rss = _medir_barajado(fuente, entrada, salidas[nombre])
+                print(
+                    f"{mb:>6g} MB {nombre:<10} {segundos * 1000:9.1f} ms"
+                    f"  pico {rss / 2**20:8.1f} MiB ({rss / tam:5.1f}x el fichero)"
+                )
+                resultados[f"{mb:g}MB/{nombre}"] = {"segundos": segundos, "pico_bytes": rss, "bytes": tam}
+            with open(salidas["anterior"], "rb") as a, open(salidas["actual"], "rb") as b:
+                iguales = a.read() == b.read()
+            print(f"{'':>9} salida idéntica: {'sí' if iguales else 'NO'}")
+            resultados[f"{mb:g}MB/iguales"] = iguales
+    guardar_json(args.json, {"barajado": resultados})
+
+
+# ╔════════════ RESUMEN DE TRAZAS (CODERUNNER_TRAZA) ═══════════╗
+
+def bench_trazas(args):
+    """
+    Agrega los ficheros JSONL escritos con CODERUNNER_TRAZA y muestra
+    p50/p95/p99 por fase, ordenadas por el tiempo total que consumen.
+    """
+    fases = {}
+    for ruta in args.ficheros:
+        with open(ruta, encoding="utf8") as f:
+            for linea in f:
+                if not linea.strip():
+                    continue
+                traza = json.loads(linea)
+                fases.setdefault("total", []).append(traza["total"])
+                for nombre, segundos in traza["fases"].items():
+                    fases.setdefault(nombre, []).append(segundos)
+
+    total = sum(fases.get("total", [])) or 1.0
+    orden = sorted(fases, key=lambda n: -sum(fases[n]))
+    print(f"{len(fases.get('total', []))} tests")
+    for nombre in orden:
+        parte = 100 * sum(fases[nombre]) / total
+        resumen(f"{nombre} ({parte:.0f}%)", fases[nombre])
+
+
+# ╔════════════ REGRESIONES ═══════════════════════════════════╗
+
+def corregir(valores, llamada="do_testing()", adjuntos=None, entorno=None):
+    """
+    Corrige un envío con la plantilla renderizada en un directorio temporal
+    y devuelve el resultado JSON que imprime (la última línea de su salida).
+    """
+    with tempfile.TemporaryDirectory() as d:
+        for nombre, contenido in (adjuntos or {}).items():
+            with open(os.path.join(d, nombre), "w", encoding="utf8") as f:
+                f.write(contenido)
+        with open(os.path.join(d, "prog.py"), "w", encoding="utf8") as f:
+            f.write(renderizar_plantilla(valores, llamada))
+        p = subprocess.run(
+            [sys.executable, "prog.py"], cwd=d, capture_output=True, text=True,
+            env={**os.environ, "CODERUNNER_CACHE_DIR": "", **(entorno or {})}, timeout=120
+        )
+    lineas = p.stdout.strip().splitlines()
+    if not lineas:
+        raise AssertionError(f"la plantilla no imprimió nada:\n{p.stderr[-2000:]}")
+    return json.loads(lineas[-1])
+
+
+def _regresion_fichero_sin_cerrar(backend):
+    """
+    El programa de ejemplo (Plantilla) escribe salida.txt sin cerrarlo: el
+    búfer tiene que llegar al disco también cuando el hijo acaba con os._exit.
+    """
+    with open(os.path.join(RAIZ, "Plantilla"), encoding="utf8") as f:
+        programa = f.read()
+    r = corregir(
+        {
+            "QUESTION.answer": programa,
+            "STUDENT_ANSWER": programa,
+            "ATTACHMENTS": "entrada.txt",
+            "TEST.stdin": "hola\n",
+            "TEST.extra": "salida.txt",
+        },
+        adjuntos={"entrada.txt": "abc"},
+        entorno={"CODERUNNER_BACKEND": backend},
+    )
+    assert "hola|abc" in r["expected"], r["expected"]
+    assert r["fraction"] == 1, r["got"]
+
+
+# Busca la respuesta del patrón desde el programa del alumno: en los marcos
+# que tiene por encima y en las funciones que alcanza el recolector
+_BUSCAR_PATRON = """\
+import gc, sys
+secreto = "-".join(["secreto", "del", "patron"])
+
+def contiene(x):
+    try:
+        return secreto in repr(x)
+    except Exception:
+        return False
+
+fuga = False
+marco = sys._getframe().f_back
+while marco is not None:
+    fuga = fuga or contiene(marco.f_locals) or contiene(marco.f_code.co_consts)
+    marco = marco.f_back
+for o in gc.get_objects():
+    codigo = getattr(o, "__code__", None)
+    fuga = fuga or (codigo is not None and contiene(codigo.co_consts))
+print("fuga" if fuga else "limpio")
+"""
+
+
+def _regresion_respuesta_inaccesible(backend):
+    """
+    El programa del alumno no puede leer la respuesta del patrón recorriendo
+    los marcos del corrector ni con gc.
+    """
+    r = corregir(
+        {
+            "QUESTION.answer": 'secreto = "secreto-del-patron"\nprint("limpio")\n',
+            "STUDENT_ANSWER": _BUSCAR_PATRON,
+            "TEST.stdin": "",
+        },
+        entorno={"CODERUNNER_BACKEND": backend},
+    )
+    assert r["fraction"] == 1, r["got"]
+
+
+def _regresion_limites_en_frio(backend):
+    """
+    Un programa que gasta 2 s de CPU donde el patrón no gasta nada supera los
+    límites del alumno tanto si el patrón está en la caché como si no.
+    """
+    valores = {
+        "QUESTION.answer": "print(input())\n",
+        "STUDENT_ANSWER": "import time\nfin = time.process_time() + 2\n"
+                          "while time.process_time() < fin:\n    pass\nprint(input())\n",
+        "TEST.stdin": "hola\n",
+    }
+    with tempfile.TemporaryDirectory() as cache:
+        entorno = {"CODERUNNER_BACKEND": backend, "CODERUNNER_CACHE_DIR": cache, "CODERUNNER_CACHE_VEREDICTOS": "0"}
+        notas = [corregir(valores, entorno=entorno)["fraction"] for _ in range(2)]
+    assert notas == [0, 0], f"notas en frío y en caliente: {notas}"
+
+
+def _regresion_comparacion_invalida(backend):
+    """
+    Una política de comparación desconocida o con argumentos que no valen se
+    corrige como "Error en la pregunta" con nota 0, sin excepción.
+    """
+    for politica in ("reales abc", "inventada"):
+        r = corregir(
+            {
+                "QUESTION.answer": "print(1)",
+                "STUDENT_ANSWER": "print(1)",
+                "TEST.stdin": "",
+                "TEST.extra": "comparacion: " + politica,
+            },
+            entorno={"CODERUNNER_BACKEND": backend},
+        )
+        assert "Error en la pregunta" in r["got"] and r["fraction"] == 0, r
+
+
+REGRESIONES = {
+    "fichero_sin_cerrar": _regresion_fichero_sin_cerrar,
+    "respuesta_inaccesible": _regresion_respuesta_inaccesible,
+    "limites_en_frio": _regresion_limites_en_frio,
+    "comparacion_invalida": _regresion_comparacion_invalida,
+}
+
+
+def bench_regresiones(args):
+    """
+    Comprueba con cada backend comportamientos que ya se rompieron alguna
+    vez. Termina con código 1 si falla alguna.
+    """
+    fallos = 0
+    for nombre, comprobar in REGRESIONES.items():
+        for backend in args.backend:
+            try:
+                comprobar(backend)
+            except AssertionError as e:
+                fallos += 1
+                print(f"FALLO {nombre} [{backend}]: {e}")
+            else:
+                print(f"ok    {nombre} [{backend}]")
+    if fallos:
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("backends", help="latencia de run_py por backend")
+    p.add_argument("-n", type=int, default=50)
+    p.set_defaults(func=bench_backends)
+
+    p = sub.add_parser("plantilla", help="envíos/s, latencia y memoria de plantilla.py")
+    p.add_argument("-n", type=int, default=20, help="envíos por escenario")
+    p.add_argument("-j", type=int, default=1, help="correcciones en paralelo")
+    p.add_argument("--combinator", action="store_true", help="todos los tests en una invocación")
+    p.add_argument("--escenario", action="append", choices=sorted(ESCENARIOS))
+    p.add_argument("--json", help="guardar los resultados en este fichero")
+    p.set_defaults(func=bench_plantilla)
+
+    p = sub.add_parser("libreria", help="evaluaciones/s, latencia y memoria de libreria.py")
+    p.add_argument("-n", type=int, default=200)
+    p.add_argument("--referencia", help="otra versión de libreria.py con la que comparar")
+    p.add_argument("-j", type=int, default=1, help="medir también el pipeline con J hilos a la vez")
+    p.add_argument("--json", help="guardar los resultados en este fichero")
+    p.set_defaults(func=bench_libreria)
+
+    p = sub.add_parser("trazas", help="p50/p95/p99 por fase de ficheros de traza")
+    p.add_argument("ficheros", nargs="+")
+    p.set_defaults(func=bench_trazas)
+
+    p = sub.add_parser("barajado", help="tiempo y memoria de barajar_fichero con CSV grandes")
+    p.add_argument("--mb", type=float, nargs="+", default=[1, 10, 100], help="tamaños del CSV")
+    p.add_argument("--json", help="guardar los resultados en este fichero")
+    p.set_defaults(func=bench_barajado)
+
+    p = sub.add_parser("regresiones", help="comprobaciones de errores ya corregidos")
+    p.add_argument("--backend", nargs="+", default=["fork", "subprocess"], choices=["fork", "subprocess"])
+    p.set_defaults(func=bench_regresiones)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Piezas comunes de benchmark.py y recalificar.py: plantilla.py renderizada
+como lo hace CodeRunner, la evaluación de un caso con el pipeline de
+libreria.py y percentiles.
+
+No importa plantilla.py: la plantilla se lee como texto y se ejecuta
+renderizada en un proceso aparte.
+"""
+import json, os, re
+
+import libreria
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    if not valores:
+        return 0.0
+    k = min(len(valores) - 1, max(0, round(p / 100 * (len(valores) - 1))))
+    return valores[k]
+
+
+# ╔════════════ PLANTILLA RENDERIZADA (plantilla.py) ══════════╗
+
+def escapar_py(valor):
+    """
+    Equivalente al filtro e('py') de CodeRunner: deja el valor listo para
+    ir dentro de un literal de cadena de Python.
+    """
+    return (
+        valor.replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("'", "\\'")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+_marcador_re = re.compile(r"\{\{\s*([\w.]+)\s*((?:\|\s*\w+(?:\([^)]*\))?\s*)*)\}\}")
+
+
+def renderizar_plantilla(valores, llamada="do_testing()", fuente=None):
+    """
+    Sustituye los marcadores Twig de plantilla.py ({{ X | e('py') }} y
+    {{ X | json_encode | e('py') }}) por los valores de "valores" y añade
+    la llamada de entrada al final.
+    """
+    if fuente is None:
+        with open(os.path.join(RAIZ, "plantilla.py"), encoding="utf8") as f:
+            fuente = f.read()
+
+    def sustituir(m):
+        nombre, filtros = m.group(1), m.group(2)
+        valor = valores.get(nombre, "")
+        if "json_encode" in filtros:
+            valor = json.dumps(valor)
+        return escapar_py(valor)
+
+    return _marcador_re.sub(sustituir, fuente) + "\n\n" + llamada + "\n"
+
+
+# ╔════════════ PIPELINE EN PROCESO (libreria.py) ═════════════╗
+
+def evaluar_con_pipeline(caso, directorio_propio=False):
+    """
+    Evalúa CASO ({"parametros", "patron", "alumno"}) con el pipeline de
+    libreria.py (un único Contexto, sin copias) y devuelve el Contexto.
+    Patrón y alumno se cargan en globales distintos. Con DIRECTORIO_PROPIO los ficheros de cada programa van a un directorio
+    temporal, para evaluar desde varios hilos a la vez.
+    """
+    params = json.dumps(caso["parametros"])
+    if caso["parametros"].get("tipo") == "funcion":
+        def cargar_funciones():
+            patron, alumno = {}, {}
+            exec(caso["patron"], patron)
+            exec(caso["alumno"], alumno)
+            return patron, alumno
+        return libreria.evaluar_funcion(params, caso["alumno"], cargar_funciones)
+    return libreria.evaluar_programa(
+        params, caso["alumno"],
+        lambda: exec(caso["patron"], {}),
+        lambda: exec(caso["alumno"], {}),
+        directorio_propio,
+    )
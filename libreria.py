@@ -1,30 +1,374 @@
-import sys, os, json, re
+import sys, os, json, re, ast, hashlib, string, copy, contextlib, contextvars, builtins, marshal, shutil, signal, stat, tempfile, threading, time, types
 from io import StringIO
+from collections import OrderedDict
+from collections.abc import MutableMapping
 import random as r
 
 
+# ╔════════════ CONTEXTO DE LA EVALUACIÓN ══════════════════════╗
+
+CAMPOS_CONTEXTO = (
+    # cargar_parametros
+    "ejercicio", "tipo", "nombre_funcion_patron", "nombre_funcion_alumno", "nombre_funcion",
+    "spec_entrada_estandar", "spec_ficheros_entrada", "spec_argumentos",
+    "ficheros_salida", "restricciones", "casos", "tiempo_por_llamada",
+    # comprobar_restricciones
+    "bloquear_ejecucion", "codigo_alumno",
+    # preparar_contexto
+    "semilla", "entrada_estandar", "ficheros_entrada", "argumentos", "casos_argumentos",
+    # entornos patrón / alumno
+    "salida_patron", "ficheros_patron_dict", "ficheros_patron_html",
+    "salida_alumno", "ficheros_alumno_dict", "ficheros_alumno_html",
+    # evaluar_* y construir_resultado
+    "coinciden", "award", "casos_superados", "ficheros_comparados", "html", "resultado",
+)
+_CAMPOS = frozenset(CAMPOS_CONTEXTO)
+
+
+class Contexto(MutableMapping):
+    """
+    Estado de una evaluación. Las etapas lo modifican en el sitio (antes cada
+    una hacía dict(contexto)) y leen y escriben sus campos como atributos.
+
+    También se comporta como el dict de antes, para las plantillas de pregunta
+    existentes: CONTEXTO["clave"], get, in, update, dict(CONTEXTO)... Un campo
+    sin asignar es una clave que no existe, y las claves que no son campos
+    (p. ej. "_patron_out") van a "extras".
+    """
+    __slots__ = CAMPOS_CONTEXTO + ("extras",)
+
+    def __init__(self, datos=(), **kwargs):
+        self.extras = {}
+        self.update(datos, **kwargs)
+
+    def __getitem__(self, clave):
+        if clave in _CAMPOS:
+            try:
+                return getattr(self, clave)
+            except AttributeError:
+                raise KeyError(clave) from None
+        return self.extras[clave]
+
+    def __setitem__(self, clave, valor):
+        if clave in _CAMPOS:
+            setattr(self, clave, valor)
+        else:
+            self.extras[clave] = valor
+
+    def __delitem__(self, clave):
+        if clave in _CAMPOS:
+            try:
+                delattr(self, clave)
+            except AttributeError:
+                raise KeyError(clave) from None
+        else:
+            del self.extras[clave]
+
+    def __contains__(self, clave):
+        if clave in _CAMPOS:
+            return hasattr(self, clave)
+        return clave in self.extras
+
+    def get(self, clave, defecto=None):
+        if clave in _CAMPOS:
+            return getattr(self, clave, defecto)
+        return self.extras.get(clave, defecto)
+
+    def __iter__(self):
+        for campo in CAMPOS_CONTEXTO:
+            if hasattr(self, campo):
+                yield campo
+        yield from self.extras
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return Contexto(self)
+
+    def __repr__(self):
+        return f"Contexto({dict(self)!r})"
+
+
+def como_contexto(contexto):
+    """
+    Devuelve CONTEXTO como Contexto: el mismo objeto si ya lo es (sin copiar)
+    o uno nuevo con las claves del dict (el de una plantilla antigua).
+    """
+    if isinstance(contexto, Contexto):
+        return contexto
+    return Contexto(contexto or {})
+
+
+# ╔════════════ CAPTURA DE E/S POR EVALUACIÓN ══════════════════╗
+
+# Cada evaluación (hilo o tarea asyncio) tiene su propia E/S en una variable
+# de contexto: {"stdout": StringIO, "stdin": StringIO, "directorio": ruta}.
+# sys.stdout, sys.stdin y open se sustituyen una sola vez por intermediarios
+# que usan la E/S de la evaluación en curso o, si no hay, la original. Así
+# varias evaluaciones pueden ejecutarse a la vez en el mismo intérprete.
+# Con directorio propio (temporal, creado la primera vez que hace falta) las
+# rutas relativas de open van a él; si no, todo usa el directorio de trabajo.
+_captura = contextvars.ContextVar("captura_libreria", default=None)
+_open = builtins.open
+
+
+class _FlujoDeContexto:
+    """sys.stdout / sys.stdin que escribe o lee en el de la evaluación en curso."""
+    __slots__ = ("_clave", "_original")
+
+    def __init__(self, clave, original):
+        self._clave = clave
+        self._original = original
+
+    def _actual(self):
+        captura = _captura.get()
+        return captura[self._clave] if captura is not None else self._original
+
+    def write(self, texto):
+        return self._actual().write(texto)
+
+    def readline(self, *args):
+        return self._actual().readline(*args)
+
+    def __iter__(self):
+        return iter(self._actual())
+
+    def __getattr__(self, nombre):
+        return getattr(self._actual(), nombre)
+
+
+def _open_de_contexto(file, *args, **kwargs):
+    # Las rutas relativas se resuelven en el directorio de la evaluación
+    captura = _captura.get()
+    if captura is not None and captura["propio"] and isinstance(file, (str, bytes, os.PathLike)):
+        ruta = os.fspath(file)
+        if not os.path.isabs(ruta):
+            directorio = _directorio_de(captura)
+            file = os.path.join(os.fsencode(directorio) if isinstance(ruta, bytes) else directorio, ruta)
+    return _open(file, *args, **kwargs)
+
+
+_instalacion = threading.Lock()
+
+
+def instalar_captura():
+    """
+    Pone los intermediarios en sys.stdout, sys.stdin y builtins.open (si ya
+    están, no hace nada). Si alguien restaura sys.stdout, se vuelven a poner
+    en la siguiente evaluación. Solo se redirige open: os.listdir, os.open o
+    pathlib siguen usando el directorio de trabajo real (por eso el
+    directorio propio es opcional).
+    """
+    with _instalacion:
+        if not isinstance(sys.stdout, _FlujoDeContexto):
+            sys.stdout = _FlujoDeContexto("stdout", sys.stdout)
+        if not isinstance(sys.stdin, _FlujoDeContexto):
+            sys.stdin = _FlujoDeContexto("stdin", sys.stdin)
+        builtins.open = _open_de_contexto
+
+
+def _directorio_de(captura):
+    if captura["directorio"] is None:
+        captura["directorio"] = tempfile.mkdtemp(prefix="libreria_")
+    return captura["directorio"]
+
+
+def directorio_trabajo():
+    """Directorio de trabajo de la evaluación en curso (o el actual)."""
+    captura = _captura.get()
+    return _directorio_de(captura) if captura is not None else "."
+
+
+# mtime con el que se marcan los ficheros de entrada: cualquier escritura lo
+# cambia, aunque deje el mismo tamaño en el mismo tic del reloj
+_MTIME_INTACTO = 0
+
+
+def abrir_captura(entrada="", ficheros=None, directorio_propio=True):
+    """
+    Empieza una captura: salida nueva, ENTRADA como stdin y FICHEROS en un
+    directorio temporal propio o, sin DIRECTORIO_PROPIO, en el directorio de
+    trabajo. Devuelve (captura, token) para cerrar_captura. Afecta solo al
+    contexto actual (hilo o tarea).
+    """
+    instalar_captura()
+    captura = {
+        "stdout": StringIO(),
+        "stdin": StringIO(entrada),
+        "directorio": None if directorio_propio else ".",
+        "propio": directorio_propio,
+        "antes": {},
+    }
+    if ficheros:
+        crear_ficheros(ficheros, _directorio_de(captura))
+        for nombre in ficheros:
+            os.utime(os.path.join(captura["directorio"], nombre), ns=(_MTIME_INTACTO, _MTIME_INTACTO))
+    if ficheros or not directorio_propio:
+        captura["antes"] = instantanea_directorio(captura["directorio"])
+    return captura, _captura.set(captura)
+
+
+def cerrar_captura(captura, token=None):
+    """
+    Termina la captura: devuelve stdout y stdin a la evaluación anterior (o
+    a los originales) y borra su directorio temporal, si lo tiene.
+    """
+    if token is not None:
+        try:
+            _captura.reset(token)
+        except ValueError:
+            # token de otro contexto: basta con no dejar esta captura activa
+            if _captura.get() is captura:
+                _captura.set(None)
+    if captura["propio"] and captura["directorio"] is not None:
+        shutil.rmtree(captura["directorio"], ignore_errors=True)
+
+
+def ficheros_de_captura(captura, nombres=None):
+    """
+    Los ficheros de salida de CAPTURA: los .txt creados o modificados
+    durante la ejecución o, con NOMBRES, solo esos ({} si el directorio
+    nunca se llegó a crear).
+    """
+    if captura["directorio"] is None:
+        return {}
+    return leer_ficheros_cambiados(captura["directorio"], captura["antes"], nombres)
+
+
+@contextlib.contextmanager
+def captura_es(entrada="", ficheros=None):
+    """
+    with captura_es(entrada, ficheros) as captura: ... ejecuta el bloque con
+    su propia E/S. Al salir (también con excepciones) todo queda como estaba;
+    captura["salida"] tiene lo escrito y captura["ficheros"] los .txt que
+    quedaron en su directorio.
+    """
+    captura, token = abrir_captura(entrada, ficheros)
+    try:
+        yield captura
+    finally:
+        captura["salida"] = captura["stdout"].getvalue()
+        captura["ficheros"] = ficheros_de_captura(captura)
+        cerrar_captura(captura, token)
+
+
 # ╔════════════ UTILIDADES DE FICHEROS ═════════════════════════╗
 
-def crear_ficheros(dic_ficheros):
+def crear_ficheros(dic_ficheros, directorio=None):
     """
-    Crea ficheros de texto a partir de un dict {nombre: contenido}.
+    Crea ficheros de texto a partir de un dict {nombre: contenido}, en
+    DIRECTORIO o en el directorio de trabajo de la evaluación en curso.
     """
     if not dic_ficheros:
         return
+    directorio = directorio or directorio_trabajo()
     for nombre, contenido in dic_ficheros.items():
-        with open(nombre, "w", encoding="utf-8") as f:
+        with _open(os.path.join(directorio, nombre), "w", encoding="utf-8") as f:
             f.write(contenido)
 
 
-def leer_ficheros_txt_dict():
+MAX_BYTES_FICHERO = 1 << 20
+
+
+def instantanea_directorio(directorio):
+    """
+    {nombre: (tamaño, mtime_ns, inodo)} de los ficheros de DIRECTORIO, con
+    un solo os.scandir (sin abrir ninguno).
+    """
+    instantanea = {}
+    with os.scandir(directorio) as entradas:
+        for entrada in entradas:
+            try:
+                if entrada.is_file():
+                    st = entrada.stat()
+                    instantanea[entrada.name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            except OSError:
+                pass
+    return instantanea
+
+
+def _texto(datos):
+    # como open(..., "r", errors="replace"): saltos de línea universales
+    return datos.decode("utf-8", errors="replace").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def leer_fichero_limitado(ruta, max_bytes=MAX_BYTES_FICHERO):
+    """
+    Contenido de texto de RUTA hasta MAX_BYTES. Si es más grande, se corta y
+    se añade una marca con el tamaño y el hash del resto, para que dos
+    ficheros distintos más allá del límite no parezcan iguales.
+    """
+    try:
+        with _open(ruta, "rb") as f:
+            # read(n) reserva n bytes aunque el fichero sea pequeño
+            if os.fstat(f.fileno()).st_size <= max_bytes:
+                datos = f.read()
+            else:
+                datos = f.read(max_bytes + 1)
+            if len(datos) <= max_bytes:
+                return _texto(datos)
+            h = hashlib.sha256(datos[max_bytes:])
+            resto = len(datos) - max_bytes
+            for bloque in iter(lambda: f.read(1 << 16), b""):
+                h.update(bloque)
+                resto += len(bloque)
+    except Exception:
+        return "[NO SE PUEDE LEER]"
+    return _texto(datos[:max_bytes]) + f"\n[... {resto} bytes más, sha256 {h.hexdigest()[:16]}]"
+
+
+def leer_ficheros_cambiados(directorio, antes, nombres=None, max_bytes=MAX_BYTES_FICHERO):
+    """
+    Dict {nombre: contenido} de los ficheros de salida de DIRECTORIO,
+    comparando con la instantánea ANTES (la de instantanea_directorio antes
+    de ejecutar): solo se leen los .txt nuevos o con tamaño, mtime o inodo
+    distintos. Con NOMBRES (los de ficheros_salida) se leen solo esos, con
+    el mismo criterio: uno que ya estaba y no ha cambiado (p. ej. el que dejó
+    el patrón en el directorio de trabajo) cuenta como ausente. Cada fichero
+    se lee hasta MAX_BYTES.
+    """
+    if nombres is not None:
+        candidatos = []
+        for nombre in nombres:
+            try:
+                st = os.stat(os.path.join(directorio, nombre))
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and antes.get(nombre) != (st.st_size, st.st_mtime_ns, st.st_ino):
+                candidatos.append(nombre)
+    else:
+        ahora = instantanea_directorio(directorio)
+        candidatos = [
+            nombre for nombre, firma in ahora.items()
+            if nombre.lower().endswith(".txt") and antes.get(nombre) != firma
+        ]
+    return {
+        nombre: leer_fichero_limitado(os.path.join(directorio, nombre), max_bytes)
+        for nombre in sorted(candidatos)
+    }
+
+
+def nombres_ficheros_salida(contexto):
+    """Nombres de ficheros_salida, o None si la pregunta no los declara."""
+    specs = contexto.get("ficheros_salida")
+    if not specs:
+        return None
+    return [spec.get("nombre") for spec in specs if isinstance(spec, dict) and spec.get("nombre")]
+
+
+def leer_ficheros_txt_dict(directorio=None):
     """
-    Devuelve un dict {nombre: contenido} con TODOS los .txt del directorio actual.
+    Devuelve un dict {nombre: contenido} con TODOS los .txt de DIRECTORIO (por
+    defecto, el directorio de trabajo de la evaluación en curso).
     """
+    directorio = directorio or directorio_trabajo()
     ficheros = {}
-    for nombre in sorted(os.listdir(".")):
-        if os.path.isfile(nombre) and nombre.lower().endswith(".txt"):
+    for nombre in sorted(os.listdir(directorio)):
+        ruta = os.path.join(directorio, nombre)
+        if os.path.isfile(ruta) and nombre.lower().endswith(".txt"):
             try:
-                with open(nombre, "r", encoding="utf-8", errors="replace") as f:
+                with _open(ruta, "r", encoding="utf-8", errors="replace") as f:
                     contenido = f.read()
             except Exception:
                 contenido = "[NO SE PUEDE LEER]"
@@ -60,7 +404,7 @@ def cargar_parametros(contexto, params_raw):
       - entrada_estandar -> lista de dicts (0, 1 o varios)
       - argumentos       -> lista de dicts (0, 1 o varios)
     """
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
     try:
         datos = json.loads(params_raw) if params_raw and params_raw.strip() else {}
@@ -69,89 +413,206 @@ def cargar_parametros(contexto, params_raw):
     except Exception:
         datos = {}
 
-    contexto["ejercicio"] = datos.get("ejercicio", "ejercicio_sin_nombre")
-    contexto["tipo"] = datos.get("tipo", "programa")
+    contexto.ejercicio = datos.get("ejercicio", "ejercicio_sin_nombre")
+    contexto.tipo = datos.get("tipo", "programa")
 
     # Nombres de funciones (para tipo "funcion")
-    contexto["nombre_funcion_patron"] = datos.get("nombre_funcion_patron", "sol_patron")
-    contexto["nombre_funcion_alumno"] = datos.get("nombre_funcion_alumno", "resolver")
-    contexto["nombre_funcion"] = contexto["nombre_funcion_alumno"]
+    contexto.nombre_funcion_patron = datos.get("nombre_funcion_patron", "sol_patron")
+    contexto.nombre_funcion_alumno = datos.get("nombre_funcion_alumno", "resolver")
+    contexto.nombre_funcion = contexto.nombre_funcion_alumno
 
     # --- entrada_estandar: SIEMPRE lista de diccionarios ---
     spec_in = datos.get("entrada_estandar")
     if spec_in is None:
-        contexto["spec_entrada_estandar"] = []
+        contexto.spec_entrada_estandar = []
     elif isinstance(spec_in, list):
-        contexto["spec_entrada_estandar"] = spec_in
+        contexto.spec_entrada_estandar = spec_in
     else:
-        contexto["spec_entrada_estandar"] = [spec_in]
+        contexto.spec_entrada_estandar = [spec_in]
 
     # --- ficheros_entrada: lista de diccionarios ---
-    contexto["spec_ficheros_entrada"] = datos.get("ficheros_entrada", [])
+    contexto.spec_ficheros_entrada = datos.get("ficheros_entrada", [])
 
     # --- argumentos: SIEMPRE lista de diccionarios (para funciones) ---
     spec_args = datos.get("argumentos")
     if spec_args is None:
-        contexto["spec_argumentos"] = []
+        contexto.spec_argumentos = []
     elif isinstance(spec_args, list):
-        contexto["spec_argumentos"] = spec_args
+        contexto.spec_argumentos = spec_args
     else:
-        contexto["spec_argumentos"] = [spec_args]
+        contexto.spec_argumentos = [spec_args]
+
+    # --- casos: cuántos juegos de argumentos probar (funciones) y límite por llamada ---
+    contexto.casos = datos.get("casos", 1)
+    contexto.tiempo_por_llamada = datos.get("tiempo_por_llamada")
 
     # --- ficheros_salida: qué ficheros se deben comparar (opcional) ---
-    contexto["ficheros_salida"] = datos.get("ficheros_salida", None)
+    contexto.ficheros_salida = datos.get("ficheros_salida", None)
+
+    contexto.restricciones = datos.get("restricciones", {})
 
-    contexto["restricciones"] = datos.get("restricciones", {})
+    # --- semilla: para repetir exactamente las entradas generadas (opcional) ---
+    contexto.semilla = datos.get("semilla")
 
     return contexto
 
 
 # ╔════════════ 1b) RESTRICCIONES CÓDIGO ALUMNO ════════════════╗
 
-def comprobar_restricciones(contexto, codigo_alumno):
+_MAX_ARBOLES = 64
+_arboles = OrderedDict()
+_cerrojo_arboles = threading.Lock()
+
+
+def analizar_codigo(codigo):
     """
-    Comprueba las restricciones definidas en contexto["restricciones"]
-    sobre el código fuente del alumno (cadena completa).
+    Árbol AST de CODIGO (None si tiene errores de sintaxis). Se guarda por el
+    hash del código, así que el mismo envío solo se analiza una vez.
     """
-    contexto = dict(contexto)
+    clave = hashlib.sha256(codigo.encode("utf-8", "surrogatepass")).hexdigest()
+    with _cerrojo_arboles:
+        if clave in _arboles:
+            _arboles.move_to_end(clave)
+            return _arboles[clave]
+    try:
+        arbol = ast.parse(codigo)
+    except (SyntaxError, ValueError):
+        arbol = None
+    with _cerrojo_arboles:
+        _arboles[clave] = arbol
+        if len(_arboles) > _MAX_ARBOLES:
+            _arboles.popitem(last=False)
+    return arbol
+
+
+def _raiz_modulo(nombre):
+    return (nombre or "").split(".", 1)[0]
+
+
+def _importa_modulo(nodo, modulo):
+    if isinstance(nodo, ast.Import):
+        return any(_raiz_modulo(alias.name) == modulo for alias in nodo.names)
+    if isinstance(nodo, ast.ImportFrom):
+        return nodo.level == 0 and _raiz_modulo(nodo.module) == modulo
+    # __import__("os") / importlib.import_module("os")
+    f = nodo.func
+    nombre = f.id if isinstance(f, ast.Name) else f.attr if isinstance(f, ast.Attribute) else None
+    return (
+        nombre in ("__import__", "import_module")
+        and bool(nodo.args)
+        and isinstance(nodo.args[0], ast.Constant)
+        and isinstance(nodo.args[0].value, str)
+        and _raiz_modulo(nodo.args[0].value) == modulo
+    )
 
-    restricciones = contexto.get("restricciones", {}) or {}
-    violaciones = []
 
-    # quitar comentarios simples para evitar falsos positivos
+def _reglas_restricciones(restricciones):
+    """
+    Traduce RESTRICCIONES a una lista de reglas (mensaje, tipos de nodo,
+    condición sobre el nodo, patrón textual para código que no compila),
+    en el orden en que se informan.
+      - prohibir_import / prohibir_while / prohibir_for / prohibir_eval /
+        prohibir_exec: como siempre (las comprehensions cuentan como 'for')
+      - nodos_prohibidos: nombres de nodos de ast, p. ej. ["Lambda", "Try"]
+      - builtins_prohibidos: nombres, p. ej. ["sum", "sorted"]
+      - modulos_prohibidos: módulos, p. ej. ["os", "itertools"]
+    """
+    def nombre_es(nombre):
+        return lambda nodo: nodo.id == nombre
+
+    def siempre(nodo):
+        return True
+
+    reglas = []
+    if restricciones.get("prohibir_import"):
+        reglas.append(("Uso de 'import' no permitido.", (ast.Import, ast.ImportFrom), siempre, r"\bimport\b"))
+        reglas.append(("Uso de 'import' no permitido.", (ast.Name,), nombre_es("__import__"), None))
+    if restricciones.get("prohibir_while"):
+        reglas.append(("Uso de bucles 'while' no permitido.", (ast.While,), siempre, r"\bwhile\b"))
+    if restricciones.get("prohibir_for"):
+        reglas.append((
+            "Uso de bucles 'for' no permitido.",
+            (ast.For, ast.AsyncFor, ast.comprehension), siempre, r"\bfor\b"
+        ))
+    if restricciones.get("prohibir_eval"):
+        reglas.append(("Uso de 'eval' no permitido.", (ast.Name,), nombre_es("eval"), r"\beval\s*\("))
+    if restricciones.get("prohibir_exec"):
+        reglas.append(("Uso de 'exec' no permitido.", (ast.Name,), nombre_es("exec"), r"\bexec\s*\("))
+
+    for nombre in restricciones.get("nodos_prohibidos") or []:
+        tipo = getattr(ast, nombre, None)
+        if isinstance(tipo, type) and issubclass(tipo, ast.AST):
+            reglas.append((f"Uso de '{nombre}' no permitido.", (tipo,), siempre, None))
+
+    for nombre in restricciones.get("builtins_prohibidos") or []:
+        reglas.append((
+            f"Uso de '{nombre}' no permitido.", (ast.Name,), nombre_es(nombre),
+            r"\b" + re.escape(nombre) + r"\b"
+        ))
+
+    for modulo in restricciones.get("modulos_prohibidos") or []:
+        reglas.append((
+            f"Uso del módulo '{modulo}' no permitido.",
+            (ast.Import, ast.ImportFrom, ast.Call),
+            lambda nodo, modulo=modulo: _importa_modulo(nodo, modulo),
+            r"\b(?:import|from)\s+" + re.escape(modulo) + r"\b"
+        ))
+    return reglas
+
+
+def _violaciones_ast(arbol, reglas):
+    # Una sola pasada por el árbol para todas las reglas
+    por_tipo = {}
+    for i, (_, tipos, condicion, _) in enumerate(reglas):
+        for tipo in tipos:
+            por_tipo.setdefault(tipo, []).append((i, condicion))
+    incumplidas = set()
+    for nodo in ast.walk(arbol):
+        for i, condicion in por_tipo.get(type(nodo), ()):
+            if i not in incumplidas and condicion(nodo):
+                incumplidas.add(i)
+    return [reglas[i][0] for i in sorted(incumplidas)]
+
+
+def _violaciones_texto(codigo, reglas):
+    # Código que no compila: búsqueda textual, sin comentarios
     lineas_sin_coment = []
-    for line in codigo_alumno.splitlines():
+    for line in codigo.splitlines():
         if "#" in line:
             line = line.split("#", 1)[0]
         lineas_sin_coment.append(line)
     codigo_limpio = "\n".join(lineas_sin_coment)
+    return [
+        mensaje for mensaje, _, _, patron in reglas
+        if patron and re.search(patron, codigo_limpio)
+    ]
 
-    def contiene(palabra: str) -> bool:
-        return palabra in codigo_limpio
-
-    if restricciones.get("prohibir_import"):
-        if contiene("import "):
-            violaciones.append("Uso de 'import' no permitido.")
-
-    if restricciones.get("prohibir_while"):
-        if contiene("while "):
-            violaciones.append("Uso de bucles 'while' no permitido.")
 
-    if restricciones.get("prohibir_for"):
-        if contiene("for "):
-            violaciones.append("Uso de bucles 'for' no permitido.")
+def comprobar_restricciones(contexto, codigo_alumno):
+    """
+    Comprueba las restricciones definidas en contexto["restricciones"]
+    sobre el código fuente del alumno (cadena completa), recorriendo su
+    árbol AST. Si el código no compila se busca en el texto.
+    """
+    contexto = como_contexto(contexto)
 
-    if restricciones.get("prohibir_eval"):
-        if contiene("eval("):
-            violaciones.append("Uso de 'eval' no permitido.")
+    restricciones = contexto.get("restricciones", {}) or {}
+    reglas = _reglas_restricciones(restricciones)
+    violaciones = []
 
-    if restricciones.get("prohibir_exec"):
-        if contiene("exec("):
-            violaciones.append("Uso de 'exec' no permitido.")
+    if reglas:
+        arbol = analizar_codigo(codigo_alumno)
+        if arbol is not None:
+            encontradas = _violaciones_ast(arbol, reglas)
+        else:
+            encontradas = _violaciones_texto(codigo_alumno, reglas)
+        for mensaje in encontradas:
+            if mensaje not in violaciones:
+                violaciones.append(mensaje)
 
     if not violaciones:
-        contexto["bloquear_ejecucion"] = False
-        contexto["codigo_alumno"] = codigo_alumno
+        contexto.bloquear_ejecucion = False
+        contexto.codigo_alumno = codigo_alumno
         return contexto
 
     lista_html = "".join(f"<li>{msg}</li>" for msg in violaciones)
@@ -162,91 +623,207 @@ def comprobar_restricciones(contexto, codigo_alumno):
         "</ul>"
     )
 
-    contexto["bloquear_ejecucion"] = True
-    contexto["award"] = 0.0
-    contexto["html"] = html
+    contexto.bloquear_ejecucion = True
+    contexto.award = 0.0
+    contexto.html = html
 
     resultado = {
         "fraction": 0.0,
         "prologuehtml": html
     }
-    contexto["resultado"] = json.dumps(resultado)
+    contexto.resultado = json.dumps(resultado)
 
     return contexto
 
 
 # ╔════════════ 2) GENERADORES DE DATOS (PROGRAMAS/FUNCIONES) ══╗
 
-def _gen_entero(spec):
-    minimo = spec.get("min", 1)
-    maximo = spec.get("max", 100)
-    return f"{r.randint(minimo, maximo)}\n"
+# Registro de generadores: nombre -> {"generar", "texto"}
+#   generar(spec, rng)     -> un valor Python (para argumentos de funciones)
+#   generar(spec, rng, n)  -> lista de n valores generados de una vez
+#   texto(valor, spec)     -> cadena para entrada estándar o ficheros
+# "rng" es un random.Random con la semilla del test (o el propio módulo random).
+GENERADORES = {}
 
 
-def _gen_dos_enteros(spec):
-    min_comun = spec.get("min", 1)
-    max_comun = spec.get("max", 100)
+def _texto_linea(valor, spec):
+    return f"{valor}\n"
+
+
+def _texto_lista(valor, spec):
+    separador = "\n" if spec.get("separador", "espacio") == "linea" else " "
+    return separador.join(map(str, valor)) + "\n"
+
+
+def _texto_matriz(valor, spec):
+    return "".join(" ".join(map(str, fila)) + "\n" for fila in valor)
+
+
+def _texto_tabla(valor, spec):
+    return "".join(",".join(map(str, fila)) + "\n" for fila in valor)
+
+
+def generador(nombre, texto=_texto_linea):
+    """
+    Decorador que registra FUNC(spec, rng, n) como el generador NOMBRE de
+    los specs ({"generador": NOMBRE, ...}). Con n=None devuelve un valor y
+    con un entero, una lista de n valores generados de una vez.
+    """
+    def registrar(func):
+        GENERADORES[nombre] = {"generar": func, "texto": texto}
+        return func
+    return registrar
 
-    min1 = spec.get("min1", min_comun)
-    max1 = spec.get("max1", max_comun)
-    min2 = spec.get("min2", min_comun)
-    max2 = spec.get("max2", max_comun)
 
-    a = r.randint(min1, max1)
-    b = r.randint(min2, max2)
-    return f"{a} {b}\n"
+def _enteros(rng, minimo, maximo, n):
+    # rng.choices sobre un range: una sola llamada para los n valores
+    return rng.choices(range(minimo, maximo + 1), k=n)
 
 
-def _gen_lista_enteros(spec):
+@generador("entero")
+def _generador_entero(spec, rng, n=None):
+    valores = _enteros(rng, spec.get("min", 1), spec.get("max", 100), n or 1)
+    return valores if n is not None else valores[0]
+
+
+@generador("dos_enteros", texto=lambda valor, spec: f"{valor[0]} {valor[1]}\n")
+def _generador_dos_enteros(spec, rng, n=None):
+    min_comun = spec.get("min", 1)
+    max_comun = spec.get("max", 100)
+    primeros = _enteros(rng, spec.get("min1", min_comun), spec.get("max1", max_comun), n or 1)
+    segundos = _enteros(rng, spec.get("min2", min_comun), spec.get("max2", max_comun), n or 1)
+    valores = list(zip(primeros, segundos))
+    return valores if n is not None else valores[0]
+
+
+@generador("lista_enteros", texto=_texto_lista)
+def _generador_lista_enteros(spec, rng, n=None):
     cantidad = spec.get("cantidad", 5)
-    minimo = spec.get("min", 0)
-    maximo = spec.get("max", 9)
-    separador = spec.get("separador", "espacio")
+    todos = _enteros(rng, spec.get("min", 0), spec.get("max", 9), cantidad * (n or 1))
+    listas = [todos[i:i + cantidad] for i in range(0, len(todos), cantidad)] if cantidad else [[]] * (n or 1)
+    return listas if n is not None else listas[0]
 
-    numeros = [str(r.randint(minimo, maximo)) for _ in range(cantidad)]
 
-    if separador == "linea":
-        return "\n".join(numeros) + "\n"
-    else:
-        return " ".join(numeros) + "\n"
+@generador("real")
+def _generador_real(spec, rng, n=None):
+    minimo = spec.get("min", 0.0)
+    ancho = spec.get("max", 1.0) - minimo
+    decimales = spec.get("decimales", 2)
+    valores = [round(minimo + ancho * rng.random(), decimales) for _ in range(n or 1)]
+    return valores if n is not None else valores[0]
 
 
-def _generar_desde_spec(spec):
+@generador("lista_reales", texto=_texto_lista)
+def _generador_lista_reales(spec, rng, n=None):
+    cantidad = spec.get("cantidad", 5)
+    todos = _generador_real(spec, rng, cantidad * (n or 1))
+    listas = [todos[i:i + cantidad] for i in range(0, len(todos), cantidad)] if cantidad else [[]] * (n or 1)
+    return listas if n is not None else listas[0]
+
+
+@generador("cadena")
+def _generador_cadena(spec, rng, n=None):
+    alfabeto = spec.get("alfabeto", string.ascii_lowercase)
+    longitud = spec.get("longitud", 5)
+    longitudes = _enteros(rng, spec.get("min_longitud", longitud), spec.get("max_longitud", longitud), n or 1)
+    letras = "".join(rng.choices(alfabeto, k=sum(longitudes)))
+    cadenas = []
+    i = 0
+    for k in longitudes:
+        cadenas.append(letras[i:i + k])
+        i += k
+    return cadenas if n is not None else cadenas[0]
+
+
+@generador("matriz", texto=_texto_matriz)
+def _generador_matriz(spec, rng, n=None):
+    filas = spec.get("filas", 3)
+    columnas = spec.get("columnas", 3)
+    todos = _enteros(rng, spec.get("min", 0), spec.get("max", 9), filas * columnas * (n or 1))
+    filas_planas = [todos[i:i + columnas] for i in range(0, len(todos), columnas)] if columnas else []
+    matrices = [filas_planas[i:i + filas] for i in range(0, len(filas_planas), filas)] if filas else []
+    matrices += [[[] for _ in range(filas)]] * ((n or 1) - len(matrices))
+    return matrices if n is not None else matrices[0]
+
+
+@generador("tabla_csv", texto=_texto_tabla)
+def _generador_tabla_csv(spec, rng, n=None):
     """
-    Para entrada estándar y ficheros: devuelve una CADENA.
+    "columnas": lista de specs (cada una con "nombre" y su "generador") o
+    número de columnas de enteros; "filas"; "cabecera" (por defecto sí si
+    las columnas tienen nombre). Cada columna se genera de una vez.
+    """
+    filas = spec.get("filas", 10)
+    columnas = spec.get("columnas", 3)
+    if isinstance(columnas, int):
+        columnas = [{"generador": "entero", "min": spec.get("min", 0), "max": spec.get("max", 99)}] * columnas
+    cabecera = [c.get("nombre", f"col{i + 1}") for i, c in enumerate(columnas)]
+    con_cabecera = spec.get("cabecera", any("nombre" in c for c in columnas))
+
+    tablas = []
+    for _ in range(n or 1):
+        datos = [generar_lote(c, filas, rng) for c in columnas]
+        tabla = [cabecera] if con_cabecera else []
+        tabla.extend(map(list, zip(*datos)) if datos else [[] for _ in range(filas)])
+        tablas.append(tabla)
+    return tablas if n is not None else tablas[0]
+
+
+def generar_lote(spec, n, rng=r):
+    """
+    N valores del generador de SPEC en una sola llamada (p. ej. los
+    argumentos de muchos casos, o una columna de una tabla).
     """
-    if not isinstance(spec, dict):
-        return f"{r.randint(1, 100)}\n"
+    gen = GENERADORES.get(spec.get("generador")) if isinstance(spec, dict) else None
+    if gen is None:
+        return _enteros(rng, 1, 100, n)
+    return gen["generar"](spec, rng, n)
 
-    gen = spec.get("generador")
 
-    if gen == "entero":
-        return _gen_entero(spec)
+def _gen_entero(spec, rng=r):
+    return _generar_desde_spec(dict(spec, generador="entero"), rng)
 
-    if gen == "dos_enteros":
-        return _gen_dos_enteros(spec)
 
-    if gen == "lista_enteros":
-        return _gen_lista_enteros(spec)
+def _gen_dos_enteros(spec, rng=r):
+    return _generar_desde_spec(dict(spec, generador="dos_enteros"), rng)
 
-    return f"{r.randint(1, 100)}\n"
 
+def _gen_lista_enteros(spec, rng=r):
+    return _generar_desde_spec(dict(spec, generador="lista_enteros"), rng)
 
-def _generar_valor_desde_spec(spec):
+
+def _generar_desde_spec(spec, rng=r):
     """
-    Para argumentos de funciones: devuelve un VALOR Python (int, etc.).
+    Para entrada estándar y ficheros: devuelve una CADENA.
     """
-    if not isinstance(spec, dict):
-        return r.randint(1, 100)
+    gen = GENERADORES.get(spec.get("generador")) if isinstance(spec, dict) else None
+    if gen is None:
+        return f"{rng.randint(1, 100)}\n"
+    return gen["texto"](gen["generar"](spec, rng), spec)
 
-    gen = spec.get("generador")
 
-    if gen == "entero":
-        minimo = spec.get("min", 1)
-        maximo = spec.get("max", 100)
-        return r.randint(minimo, maximo)
+def _generar_valor_desde_spec(spec, rng=r):
+    """
+    Para argumentos de funciones: devuelve un VALOR Python (int, etc.).
+    """
+    gen = GENERADORES.get(spec.get("generador")) if isinstance(spec, dict) else None
+    if gen is None:
+        return rng.randint(1, 100)
+    return gen["generar"](spec, rng)
+
 
-    return r.randint(1, 100)
+def rng_del_test(contexto):
+    """
+    Generador aleatorio propio del test. La semilla es el parámetro
+    "semilla" de la pregunta o, si no hay, una sacada del módulo random
+    (así una plantilla que fija random.seed sigue siendo reproducible).
+    Queda en contexto["semilla"] para poder repetir el test.
+    """
+    semilla = contexto.get("semilla")
+    if semilla is None:
+        semilla = r.getrandbits(32)
+    contexto.semilla = semilla
+    return r.Random(semilla)
 
 
 def preparar_contexto(contexto):
@@ -255,36 +832,45 @@ def preparar_contexto(contexto):
       - entrada_estandar (cadena)
       - ficheros_entrada (dict nombre -> contenido)
       - argumentos (lista de valores, para funciones)
+      - casos_argumentos (lista de "argumentos", si casos > 1)
     """
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
+    rng = rng_del_test(contexto)
 
     # entrada estándar
     lista_specs = contexto.get("spec_entrada_estandar", [])
     if not lista_specs:
-        contexto["entrada_estandar"] = f"{r.randint(1, 100)}\n"
+        contexto.entrada_estandar = f"{rng.randint(1, 100)}\n"
     else:
         partes = []
         for spec in lista_specs:
-            partes.append(_generar_desde_spec(spec))
-        contexto["entrada_estandar"] = "".join(partes)
+            partes.append(_generar_desde_spec(spec, rng))
+        contexto.entrada_estandar = "".join(partes)
 
     # ficheros de entrada
-    contexto["ficheros_entrada"] = {}
+    ficheros = {}
     for spec_f in contexto.get("spec_ficheros_entrada", []):
         if not isinstance(spec_f, dict):
             continue
         nombre = spec_f.get("nombre")
         if not nombre:
             continue
-        contenido = _generar_desde_spec(spec_f)
-        contexto["ficheros_entrada"][nombre] = contenido
+        ficheros[nombre] = _generar_desde_spec(spec_f, rng)
+    contexto.ficheros_entrada = ficheros
 
     # argumentos para funciones
     args_specs = contexto.get("spec_argumentos", [])
-    argumentos = []
-    for spec in args_specs:
-        argumentos.append(_generar_valor_desde_spec(spec))
-    contexto["argumentos"] = argumentos
+    casos = contexto.get("casos") or 1
+    if casos > 1:
+        # un lote por argumento y después se reparten por casos
+        columnas = [generar_lote(spec, casos, rng) for spec in args_specs]
+        contexto.casos_argumentos = [list(caso) for caso in zip(*columnas)] if columnas else [[]] * casos
+        contexto.argumentos = contexto.casos_argumentos[0]
+    else:
+        argumentos = []
+        for spec in args_specs:
+            argumentos.append(_generar_valor_desde_spec(spec, rng))
+        contexto.argumentos = argumentos
 
     return contexto
 
@@ -292,31 +878,35 @@ def preparar_contexto(contexto):
 # ╔════════════ 3) ENTORNO PATRÓN (PROGRAMAS) ══════════════════╗
 
 def preparar_entorno_patron(contexto):
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
-    patron_out = StringIO()
-    contexto["_patron_out"] = patron_out
-
-    sys.stdout = patron_out
-    sys.stdin = StringIO(contexto.get("entrada_estandar", ""))
-
-    crear_ficheros(contexto.get("ficheros_entrada", {}))
+    captura = abrir_captura(
+        contexto.get("entrada_estandar", ""), contexto.get("ficheros_entrada", {}),
+        contexto.extras.get("_directorio_propio", False),
+    )
+    contexto.extras["_patron_captura"] = captura
+    contexto.extras["_patron_out"] = captura[0]["stdout"]
 
     return contexto
 
 
 def finalizar_entorno_patron(contexto):
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
-    patron_out = contexto.get("_patron_out")
+    patron_out = contexto.extras.get("_patron_out")
     if patron_out is not None:
-        contexto["salida_patron"] = patron_out.getvalue()
+        contexto.salida_patron = patron_out.getvalue()
     else:
-        contexto["salida_patron"] = ""
+        contexto.salida_patron = ""
 
-    dic = leer_ficheros_txt_dict()
-    contexto["ficheros_patron_dict"] = dic
-    contexto["ficheros_patron_html"] = dict_ficheros_a_html(dic)
+    captura = contexto.extras.pop("_patron_captura", None)
+    if captura is not None:
+        dic = ficheros_de_captura(captura[0], nombres_ficheros_salida(contexto))
+        cerrar_captura(*captura)
+    else:
+        dic = leer_ficheros_txt_dict()
+    contexto.ficheros_patron_dict = dic
+    contexto.ficheros_patron_html = dict_ficheros_a_html(dic)
 
     return contexto
 
@@ -324,33 +914,35 @@ def finalizar_entorno_patron(contexto):
 # ╔════════════ 4) ENTORNO ALUMNO (PROGRAMAS) ══════════════════╗
 
 def preparar_entorno_alumno(contexto):
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
-    alumno_out = StringIO()
-    contexto["_alumno_out"] = alumno_out
-
-    sys.stdout = alumno_out
-    sys.stdin = StringIO(contexto.get("entrada_estandar", ""))
-
-    crear_ficheros(contexto.get("ficheros_entrada", {}))
+    captura = abrir_captura(
+        contexto.get("entrada_estandar", ""), contexto.get("ficheros_entrada", {}),
+        contexto.extras.get("_directorio_propio", False),
+    )
+    contexto.extras["_alumno_captura"] = captura
+    contexto.extras["_alumno_out"] = captura[0]["stdout"]
 
     return contexto
 
 
 def finalizar_entorno_alumno(contexto):
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
-    alumno_out = contexto.get("_alumno_out")
+    alumno_out = contexto.extras.get("_alumno_out")
     if alumno_out is not None:
-        contexto["salida_alumno"] = alumno_out.getvalue()
+        contexto.salida_alumno = alumno_out.getvalue()
     else:
-        contexto["salida_alumno"] = ""
+        contexto.salida_alumno = ""
 
-    dic = leer_ficheros_txt_dict()
-    contexto["ficheros_alumno_dict"] = dic
-    contexto["ficheros_alumno_html"] = dict_ficheros_a_html(dic)
-
-    sys.stdout = sys.__stdout__
+    captura = contexto.extras.pop("_alumno_captura", None)
+    if captura is not None:
+        dic = ficheros_de_captura(captura[0], nombres_ficheros_salida(contexto))
+        cerrar_captura(*captura)
+    else:
+        dic = leer_ficheros_txt_dict()
+    contexto.ficheros_alumno_dict = dic
+    contexto.ficheros_alumno_html = dict_ficheros_a_html(dic)
 
     return contexto
 
@@ -362,7 +954,7 @@ def evaluar_programas(contexto):
     Compara salida_patron / salida_alumno y ficheros (modo programa).
     Usa dicts de ficheros si están presentes.
     """
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
     salida_patron = contexto.get("salida_patron", "").strip()
     salida_alumno = contexto.get("salida_alumno", "").strip()
@@ -391,81 +983,274 @@ def evaluar_programas(contexto):
 
     award = 1.0 if coincide else 0.0
 
-    contexto["coinciden"] = coincide
-    contexto["award"] = award
-    contexto["ficheros_comparados"] = nombres
+    contexto.coinciden = coincide
+    contexto.award = award
+    contexto.ficheros_comparados = nombres
 
     return contexto
 
 
 # ╔════════════ 6) EVALUAR FUNCIONES ═══════════════════════════╗
 
-def evaluar_funciones(contexto, gbls):
-    contexto = dict(contexto)
+class TiempoAgotado(BaseException):
+    """
+    La función del alumno superó tiempo_por_llamada. Hereda de BaseException
+    para que un "except Exception" del código del alumno no la oculte (un
+    "except:" o "except BaseException" sí puede).
+    """
+
+
+def _alarma(signum, frame):
+    raise TiempoAgotado()
+
+
+def _puede_limitar(segundos):
+    return (bool(segundos) and hasattr(signal, "setitimer")
+            and threading.current_thread() is threading.main_thread())
+
+
+@contextlib.contextmanager
+def alarma_instalada(segundos):
+    """
+    Deja instalado el manejador de SIGALRM mientras dura el bloque, para
+    que llamar_con_limite no tenga que ponerlo y quitarlo en cada llamada.
+    """
+    if not _puede_limitar(segundos) or signal.getsignal(signal.SIGALRM) is _alarma:
+        yield
+        return
+    anterior = signal.signal(signal.SIGALRM, _alarma)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGALRM, anterior)
+
+
+def llamar_con_limite(func, args, segundos=None):
+    """
+    func(*args) con un límite de SEGUNDOS (TiempoAgotado si se supera).
+    Usa SIGALRM con setitimer, así que solo limita en el hilo principal de
+    sistemas Unix; en otro caso, o sin SEGUNDOS, es una llamada normal.
+    El manejador de Python se ejecuta entre instrucciones de bytecode: un
+    bucle que no sale de C (sum(range(10**12)), una expresión regular con
+    retroceso catastrófico) no se interrumpe hasta que termina.
+    """
+    if not _puede_limitar(segundos):
+        return func(*args)
+    with alarma_instalada(segundos):
+        return _llamar_con_alarma(func, args, segundos)
+
+
+def _llamar_con_alarma(func, args, segundos):
+    # solo programa el temporizador: el manejador ya está instalado. Si ya
+    # había uno en marcha (una llamada limitada dentro de otra), se respeta
+    # el que vence antes y al terminar se deja el de fuera con lo que le quede.
+    pendiente, _ = signal.setitimer(signal.ITIMER_REAL, segundos)
+    if pendiente and pendiente < segundos:
+        signal.setitimer(signal.ITIMER_REAL, pendiente)
+    t0 = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        if pendiente:
+            signal.setitimer(signal.ITIMER_REAL, max(pendiente - (time.monotonic() - t0), 1e-6))
+        else:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+# Resultados del patrón: (huella del código del patrón, repr(args)) -> (ok, valor)
+_MAX_MEMO_PATRON = 4096
+_memo_patron = OrderedDict()
+_cerrojo_memo = threading.Lock()
+
+
+_CONSTANTES = (int, float, complex, str, bytes, bool, type(None))
+
+
+def _nombres_globales(codigo):
+    nombres = set(codigo.co_names)
+    for const in codigo.co_consts:
+        if hasattr(const, "co_names"):
+            nombres |= _nombres_globales(const)
+    return nombres
+
+
+def huella_funcion(func):
+    """
+    Hash del bytecode de FUNC y de lo que usa de sus globales (otras
+    funciones, recursivamente, y constantes). Es igual para el mismo patrón
+    en otro envío. None si depende de algo que no se puede resumir así
+    (listas, clases, closures...): entonces su resultado no se memoriza.
+    """
+    h = hashlib.sha256()
+    vistas = set()
+    pendientes = [func]
+    while pendientes:
+        f = pendientes.pop()
+        codigo = getattr(f, "__code__", None)
+        if codigo is None or f.__closure__ or f.__kwdefaults__:
+            return None
+        if codigo in vistas:
+            continue
+        vistas.add(codigo)
+        try:
+            h.update(marshal.dumps(codigo))
+            h.update(repr(f.__defaults__).encode())
+        except ValueError:
+            return None
+        for nombre in sorted(_nombres_globales(codigo)):
+            if nombre not in f.__globals__:
+                continue
+            valor = f.__globals__[nombre]
+            if isinstance(valor, types.FunctionType):
+                pendientes.append(valor)
+            elif isinstance(valor, types.ModuleType):
+                h.update(f"{nombre}=<{valor.__name__}>".encode())
+            elif type(valor) in _CONSTANTES:
+                h.update(f"{nombre}={valor!r}".encode())
+            else:
+                return None
+    return h.hexdigest()
+
+
+def _copia(valor):
+    # marshal copia en C los tipos básicos (lo que dan los generadores)
+    try:
+        return marshal.loads(marshal.dumps(valor))
+    except ValueError:
+        return copy.deepcopy(valor)
+
+
+def resultado_patron(f_pat, args, huella=None):
+    """
+    (True, valor) o (False, mensaje de error) de f_pat(*args). Si hay HUELLA
+    se memoriza por ella y repr(args): los casos que se repiten entre envíos
+    no vuelven a ejecutar el patrón. El patrón recibe una copia de ARGS, por
+    si los modifica.
+
+    El memo vive en el proceso. En CodeRunner cada envío es un intérprete
+    nuevo y solo dura ese envío; recalificar.py lo llena una vez por
+    pregunta en cada trabajador (entradas_memo_patron, anadir_memo_patron).
+    No se guarda en disco: el código del alumno corre en este mismo proceso
+    y podría reescribir los resultados del patrón para los envíos siguientes.
+    """
+    clave = (huella, repr(args)) if huella else None
+    with _cerrojo_memo:
+        if clave in _memo_patron:
+            _memo_patron.move_to_end(clave)
+            return _memo_patron[clave]
+    try:
+        salida = (True, f_pat(*_copia(args)))
+    except Exception as e:
+        salida = (False, str(e))
+    if clave is not None:
+        with _cerrojo_memo:
+            _memo_patron[clave] = salida
+            if len(_memo_patron) > _MAX_MEMO_PATRON:
+                _memo_patron.popitem(last=False)
+    return salida
+
+
+def entradas_memo_patron():
+    """
+    Las entradas del memo del patrón que marshal puede serializar, como
+    [(clave, (ok, valor))], de la más antigua a la más reciente.
+    """
+    entradas = []
+    with _cerrojo_memo:
+        for clave, salida in _memo_patron.items():
+            try:
+                marshal.dumps(salida)
+            except ValueError:
+                continue
+            entradas.append((clave, salida))
+    return entradas
+
+
+def anadir_memo_patron(entradas):
+    """Añade al memo del patrón ENTRADAS (las de entradas_memo_patron)."""
+    with _cerrojo_memo:
+        for clave, salida in entradas:
+            _memo_patron[clave] = salida
+            _memo_patron.move_to_end(clave)
+        while len(_memo_patron) > _MAX_MEMO_PATRON:
+            _memo_patron.popitem(last=False)
+
+
+def _resultado_funciones(contexto, salida_patron, salida_alumno, coincide):
+    contexto.salida_patron = salida_patron
+    contexto.salida_alumno = salida_alumno
+    contexto.ficheros_patron_dict = {}
+    contexto.ficheros_alumno_dict = {}
+    contexto.ficheros_patron_html = ""
+    contexto.ficheros_alumno_html = ""
+    contexto.coinciden = coincide
+    contexto.award = 1.0 if coincide else 0.0
+    return contexto
+
+
+def evaluar_funciones(contexto, gbls, gbls_alumno=None):
+    """
+    Llama a la función patrón y a la del alumno con cada juego de argumentos
+    (casos_argumentos, o solo argumentos) y se para en el primer caso que no
+    coincide. En CONTEXTO quedan los argumentos y las salidas de ese caso (o
+    del último) y casos_superados. La función patrón se busca en GBLS y la
+    del alumno en GBLS_ALUMNO (por defecto, también en GBLS).
+    """
+    contexto = como_contexto(contexto)
 
     nom_pat = contexto.get("nombre_funcion_patron")
     nom_alu = contexto.get("nombre_funcion_alumno")
-    args = contexto.get("argumentos", [])
+    casos = contexto.get("casos_argumentos") or [contexto.get("argumentos", [])]
+    limite = contexto.get("tiempo_por_llamada")
 
     f_pat = gbls.get(nom_pat)
-    f_alu = gbls.get(nom_alu)
+    f_alu = (gbls if gbls_alumno is None else gbls_alumno).get(nom_alu)
+    contexto.casos_superados = 0
 
     if f_pat is None or f_alu is None:
-        contexto["salida_patron"] = f"[No se encontró la función patrón '{nom_pat}']"
-        contexto["salida_alumno"] = f"[No se encontró la función alumna '{nom_alu}']"
-        contexto["ficheros_patron_dict"] = {}
-        contexto["ficheros_alumno_dict"] = {}
-        contexto["ficheros_patron_html"] = ""
-        contexto["ficheros_alumno_html"] = ""
-        contexto["coinciden"] = False
-        contexto["award"] = 0.0
-        return contexto
+        return _resultado_funciones(
+            contexto,
+            f"[No se encontró la función patrón '{nom_pat}']",
+            f"[No se encontró la función alumna '{nom_alu}']",
+            False,
+        )
 
-    try:
-        res_pat = f_pat(*args)
-    except Exception as e:
-        contexto["salida_patron"] = f"[Error ejecutando patrón: {e}]"
-        contexto["salida_alumno"] = ""
-        contexto["ficheros_patron_dict"] = {}
-        contexto["ficheros_alumno_dict"] = {}
-        contexto["ficheros_patron_html"] = ""
-        contexto["ficheros_alumno_html"] = ""
-        contexto["coinciden"] = False
-        contexto["award"] = 0.0
-        return contexto
+    huella = huella_funcion(f_pat)
+    with alarma_instalada(limite):
+        return _evaluar_casos(contexto, f_pat, f_alu, casos, huella, limite)
 
-    try:
-        res_alu = f_alu(*args)
-    except Exception as e:
-        contexto["salida_patron"] = repr(res_pat)
-        contexto["salida_alumno"] = f"[Error ejecutando función del alumno: {e}]"
-        contexto["ficheros_patron_dict"] = {}
-        contexto["ficheros_alumno_dict"] = {}
-        contexto["ficheros_patron_html"] = ""
-        contexto["ficheros_alumno_html"] = ""
-        contexto["coinciden"] = False
-        contexto["award"] = 0.0
-        return contexto
 
-    coincide = (res_alu == res_pat)
-    award = 1.0 if coincide else 0.0
+def _evaluar_casos(contexto, f_pat, f_alu, casos, huella, limite):
+    limitar = _puede_limitar(limite)
+    for args in casos:
+        contexto.argumentos = args
+        ok, res_pat = resultado_patron(f_pat, args, huella)
+        if not ok:
+            return _resultado_funciones(contexto, f"[Error ejecutando patrón: {res_pat}]", "", False)
 
-    contexto["salida_patron"] = repr(res_pat)
-    contexto["salida_alumno"] = repr(res_alu)
-    contexto["ficheros_patron_dict"] = {}
-    contexto["ficheros_alumno_dict"] = {}
-    contexto["ficheros_patron_html"] = ""
-    contexto["ficheros_alumno_html"] = ""
-    contexto["coinciden"] = coincide
-    contexto["award"] = award
+        try:
+            res_alu = _llamar_con_alarma(f_alu, args, limite) if limitar else f_alu(*args)
+        except TiempoAgotado:
+            return _resultado_funciones(
+                contexto, repr(res_pat),
+                f"[La función del alumno superó el tiempo límite ({limite} s)]", False,
+            )
+        except Exception as e:
+            return _resultado_funciones(
+                contexto, repr(res_pat), f"[Error ejecutando función del alumno: {e}]", False,
+            )
 
-    return contexto
+        if res_alu != res_pat:
+            return _resultado_funciones(contexto, repr(res_pat), repr(res_alu), False)
+        contexto.casos_superados += 1
+
+    return _resultado_funciones(contexto, repr(res_pat), repr(res_alu), True)
 
 
 # ╔════════════ 7) CONSTRUIR RESULTADO (HTML + JSON) ═══════════╗
 
 def construir_resultado(contexto):
-    contexto = dict(contexto)
+    contexto = como_contexto(contexto)
 
     tipo = contexto.get("tipo", "programa")
 
@@ -478,9 +1263,15 @@ def construir_resultado(contexto):
     if tipo == "funcion":
         argumentos = contexto.get("argumentos", [])
         args_str = ", ".join(repr(a) for a in argumentos)
+        casos = contexto.get("casos_argumentos")
+        superados = (
+            f"<b>Casos superados:</b> {contexto.get('casos_superados', 0)} de {len(casos)}<br>"
+            if casos else ""
+        )
 
         html = (
             "<b>Evaluación de función</b><br>"
+            + superados +
             f"<b>Argumentos usados:</b> <pre>{args_str}</pre>"
             "<table style='width:100%; border-collapse:collapse; margin-top:0.5em;'>"
             "<tr>"
@@ -543,13 +1334,82 @@ def construir_resultado(contexto):
             "</table>"
         )
 
-    contexto["html"] = html
+    contexto.html = html
 
     resultado = {
         "fraction": award,
         "prologuehtml": html
     }
 
-    contexto["resultado"] = json.dumps(resultado)
+    contexto.resultado = json.dumps(resultado)
+
+    return contexto
+
 
+# ╔════════════ 8) PIPELINE COMPLETO ═══════════════════════════╗
+
+def ejecutar_pipeline(contexto, etapas):
+    """
+    Pasa CONTEXTO por las etapas en orden, sobre el mismo objeto y sin
+    copiarlo. Cada etapa recibe el contexto (lo que devuelva se ignora).
+    Se detiene en cuanto una etapa marca bloquear_ejecucion.
+    """
+    contexto = como_contexto(contexto)
+    for etapa in etapas:
+        etapa(contexto)
+        if contexto.get("bloquear_ejecucion"):
+            break
     return contexto
+
+
+def evaluar_programa(params_raw, codigo_alumno, ejecutar_patron, ejecutar_alumno,
+                     directorio_propio=False):
+    """
+    Evaluación completa de tipo "programa". ejecutar_patron() y
+    ejecutar_alumno() ejecutan cada programa con stdin/stdout ya redirigidos.
+    Devuelve el Contexto (CONTEXTO["resultado"] es el JSON para CodeRunner).
+
+    Todo se ejecuta en una copia del contexto de contextvars. Para llamarla
+    a la vez desde varios hilos o tareas hay que pasar DIRECTORIO_PROPIO:
+    cada programa tiene entonces open() en un directorio temporal propio
+    (os.listdir, os.path o pathlib siguen viendo el de trabajo). Sin él los
+    ficheros están en el directorio de trabajo, como con las etapas una a una.
+    """
+    contexto = Contexto()
+    contexto.extras["_directorio_propio"] = directorio_propio
+    try:
+        return contextvars.copy_context().run(ejecutar_pipeline, contexto, [
+            lambda c: cargar_parametros(c, params_raw),
+            lambda c: comprobar_restricciones(c, codigo_alumno),
+            preparar_contexto,
+            preparar_entorno_patron,
+            lambda c: ejecutar_patron(),
+            finalizar_entorno_patron,
+            preparar_entorno_alumno,
+            lambda c: ejecutar_alumno(),
+            finalizar_entorno_alumno,
+            evaluar_programas,
+            construir_resultado,
+        ])
+    finally:
+        # si una etapa falló a medias, quedan directorios temporales por borrar
+        for clave in ("_patron_captura", "_alumno_captura"):
+            captura = contexto.extras.pop(clave, None)
+            if captura is not None:
+                cerrar_captura(captura[0])
+
+
+def evaluar_funcion(params_raw, codigo_alumno, cargar_funciones):
+    """
+    Evaluación completa de tipo "funcion". cargar_funciones() se llama solo
+    si se cumplen las restricciones y devuelve dos diccionarios de globales:
+    el del patrón y el del alumno. Tienen que ser distintos para que el
+    alumno no pueda redefinir la función patrón. Devuelve el Contexto.
+    """
+    return ejecutar_pipeline(Contexto(), [
+        lambda c: cargar_parametros(c, params_raw),
+        lambda c: comprobar_restricciones(c, codigo_alumno),
+        preparar_contexto,
+        lambda c: evaluar_funciones(c, *cargar_funciones()),
+        construir_resultado,
+    ])
@@ -1,28 +1,391 @@
-import subprocess, sys, json, os, html, re, hashlib, random
+import subprocess, sys, json, os, html, re, hashlib, random, tempfile
+import codecs, shutil, time, locale, atexit, selectors, importlib, io
+import math, signal, socket, stat, types, functools, fcntl, itertools, collections, difflib, marshal, importlib.util
 
 MAX_CHARS = 4000
 _ws_re = re.compile(r"[ \t]+")
 
+# Caché en disco compartida entre ejecuciones del corrector (patrón, adjuntos
+# barajados, veredictos). Desactivada salvo que se indique un directorio: sus
+# entradas se usan tal cual, así que tiene que estar donde los programas
+# corregidos no puedan escribir (otro usuario, otros permisos)
+CACHE_DIR = os.environ.get("CODERUNNER_CACHE_DIR", "")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Los adjuntos barajados tienen su propio espacio, mayor: cada entrada es un fichero entero
+CACHE_BARAJADO_MAX_BYTES = int(os.environ.get("CODERUNNER_CACHE_BARAJADO_MAX_BYTES", 256 * 1024 * 1024))
+# Resultados completos de envíos ya corregidos ("0" desactiva esta caché)
+CACHE_VEREDICTOS = os.environ.get("CODERUNNER_CACHE_VEREDICTOS", "1") == "1"
+CACHE_VEREDICTOS_MAX_BYTES = int(os.environ.get("CODERUNNER_CACHE_VEREDICTOS_MAX_BYTES", 64 * 1024 * 1024))
+
+# Backend de ejecución: "fork" (servidor fork precalentado) o "subprocess"
+BACKEND = os.environ.get("CODERUNNER_BACKEND", "fork" if hasattr(os, "fork") else "subprocess")
+TIMEOUT = 4
+
+# Límites del alumno a partir del coste medido del patrón: factor * coste,
+# acotado entre un mínimo y un máximo. Sin coste conocido solo se aplica TIMEOUT.
+LIMITE_FACTOR = 3.0
+LIMITE_CPU_MIN = 1.0
+LIMITE_PARED_MIN = 1.5
+LIMITE_PARED_MAX = 20.0
+LIMITE_MEM_FACTOR = 4.0
+LIMITE_MEM_MIN = int(os.environ.get("CODERUNNER_LIMITE_MEM_MIN", 1024 * 1024 * 1024))
+
+# Bytes de stdout + stderr que se capturan como máximo; al superarlos se mata el hijo
+MAX_OUTPUT_BYTES = int(os.environ.get("CODERUNNER_MAX_OUTPUT_BYTES", 1024 * 1024))
+
+# Módulos que importa una vez el servidor fork y heredan sus hijos
+MODULOS_PRECARGADOS = (
+    "math", "random", "string", "collections", "itertools", "functools",
+    "operator", "re", "json", "csv", "copy", "heapq", "bisect", "time",
+    "datetime", "fractions", "decimal", "statistics",
+)
+
+# Traza de tiempos por fase: fichero JSONL donde añadirla y/o campo "traza" en el resultado
+TRAZA_FICHERO = os.environ.get("CODERUNNER_TRAZA", "")
+TRAZA_EN_RESULTADO = os.environ.get("CODERUNNER_TRAZA_RESULTADO", "0") == "1"
+
+# Fichero de métricas en formato de texto de Prometheus (acumuladas entre ejecuciones)
+METRICAS_FICHERO = os.environ.get("CODERUNNER_METRICAS", "")
+
+# Comparar stdout del alumno mientras se ejecuta y pararlo en la primera diferencia
+PARADA_TEMPRANA = os.environ.get("CODERUNNER_PARADA_TEMPRANA", "0") == "1"
+
+# Tamaño máximo del informe HTML (caracteres de contenido, para todos los
+# tests de la invocación) y forma del diff de los tests fallidos
+HTML_MAX_CHARS = int(os.environ.get("CODERUNNER_HTML_MAX_CHARS", 200000))
+DIFF_CONTEXTO = 3
+DIFF_MAX_LINEAS = 40
+DIFF_VENTANA = 400
+
+_ENCODING = locale.getpreferredencoding(False)
+
+# Directorios de ejecución: en tmpfs si está disponible ("" = directorio actual)
+SANDBOX_DIR = os.environ.get(
+    "CODERUNNER_SANDBOX_DIR",
+    "/dev/shm" if os.access("/dev/shm", os.W_OK) else ""
+)
+
 # =========================================================
 # Utilidades generales
 # =========================================================
 
-def run_py(code, stdin=""):
-    with open("prog.py", "w", encoding="utf8") as f:
+def run_py(code, stdin="", cwd=None):
+    return resultado_run_py(ejecutar_varios([{"code": code, "stdin": stdin, "cwd": cwd}])[0])
+
+def resultado_run_py(r):
+    if r["timeout"]:
+        return "", "Timeout expired"
+    if r["limite_salida"]:
+        return r["stdout"], (r["stderr"] + "\n" if r["stderr"] else "") + "Output limit exceeded"
+    return r["stdout"], r["stderr"]
+
+def ejecutar_varios(trabajos):
+    # Lanza todos los trabajos (argumentos de lanzar) a la vez y espera a que terminen
+    return supervisar([lanzar(**t) for t in trabajos])
+
+def lanzar(code, stdin="", cwd=None, vigilante=None, limites=None, precompilar=False):
+    # Con "precompilar" el código compilado se reutiliza entre ejecuciones (patrón)
+    # Con vigilante el stdout del hijo va por líneas: si no, no llega nada
+    # hasta que se llena el búfer (8 KiB) o el programa termina
+    limites = limites or {"pared": TIMEOUT}
+    modulo_preludio()
+    codigo, ruta_codigo = compilar_en_cache(code) if precompilar else (None, "")
+    por_lineas = vigilante is not None
+    if BACKEND == "fork":
+        t = lanzar_fork(code, stdin, cwd, limites, codigo, por_lineas)
+    else:
+        t = lanzar_subprocess(code, stdin, cwd, limites, ruta_codigo, por_lineas)
+    t["_inicio"] = time.monotonic()
+    t["_limite"] = t["_inicio"] + limites["pared"]
+    if vigilante is not None:
+        t["vigilante"] = vigilante
+        t["_decoder"] = codecs.getincrementaldecoder(_ENCODING)(errors="replace")
+    return t
+
+def _tuberias():
+    r_in, w_in = os.pipe()
+    r_out, w_out = os.pipe()
+    r_err, w_err = os.pipe()
+    return (r_in, w_out, w_err), (w_in, r_out, r_err)
+
+def _trabajo(pid, padre, stdin):
+    w_in, r_out, r_err = padre
+    return {
+        "pid": pid,
+        "stdin": w_in,
+        "stdout": r_out,
+        "stderr": r_err,
+        "entrada": (stdin or "").encode(_ENCODING),
+    }
+
+def lanzar_subprocess(code, stdin="", cwd=None, limites=None, ruta_codigo="", por_lineas=False):
+    with open(os.path.join(cwd or ".", "prog.py"), "w", encoding="utf8") as f:
         f.write(code)
+    hijo, padre = _tuberias()
     try:
-        r = subprocess.run(
-            [sys.executable, "-B", "prog.py"],
-            input=stdin,
-            capture_output=True,
-            text=True,
-            timeout=4
+        p = subprocess.Popen(
+            [sys.executable, "-B", *(["-u"] if por_lineas else []), "-c", LANZADOR, _preludio["dir"], ruta_codigo],
+            stdin=hijo[0], stdout=hijo[1], stderr=hijo[2],
+            cwd=cwd,
+            preexec_fn=functools.partial(_preludio["modulo"].aplicar_limites, limites or {})
         )
-        out = r.stdout or ""
-        err = r.stderr or ""
-        return out, err
-    except subprocess.TimeoutExpired:
-        return "", "Timeout expired"
+    finally:
+        for fd in hijo:
+            os.close(fd)
+    t = _trabajo(p.pid, padre, stdin)
+    t["proc"] = p
+    return t
+
+# =========================================================
+# Servidor fork: intérprete precalentado, separado del corrector
+# =========================================================
+
+# Los hijos se hacen fork de un intérprete limpio (servidor del preludio) y
+# no del corrector: en el corrector están la respuesta del patrón y sus
+# marcos, alcanzables desde el programa del alumno con sys._getframe o gc
+_servidor = {}
+
+def servidor_fork():
+    # Arranca el servidor la primera vez; termina solo al cerrarse el socket
+    if "socket" not in _servidor:
+        padre, hijo = socket.socketpair()
+        try:
+            p = subprocess.Popen(
+                [sys.executable, "-B", "-c", SERVIDOR, _preludio["dir"], str(hijo.fileno()),
+                 *MODULOS_PRECARGADOS],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                pass_fds=(hijo.fileno(),)
+            )
+        finally:
+            hijo.close()
+        _servidor.update(socket=padre, proc=p)
+    return _servidor["socket"]
+
+def _salida_texto(datos):
+    s = datos.decode(_ENCODING, errors="replace")
+    return s.replace("\r\n", "\n").replace("\r", "\n")
+
+def _leer_exacto(fd, n):
+    datos = b""
+    while len(datos) < n:
+        parte = os.read(fd, n - len(datos))
+        if not parte:
+            break
+        datos += parte
+    return datos
+
+def lanzar_fork(code, stdin="", cwd=None, limites=None, codigo=None, por_lineas=False):
+    trabajo = marshal.dumps({
+        "code": code,
+        "codigo": codigo,
+        "cwd": os.path.abspath(cwd or "."),
+        "limites": limites or {},
+        "encoding": _ENCODING,
+        "por_lineas": por_lineas,
+    })
+    mensaje = len(trabajo).to_bytes(8, "little") + trabajo
+    hijo, padre = _tuberias()
+    r_estado, w_estado = os.pipe()
+    try:
+        conexion = servidor_fork()
+        n = socket.send_fds(conexion, [mensaje], [*hijo, w_estado])
+        conexion.sendall(mensaje[n:])
+    except OSError:
+        pass  # sin pid: el servidor ha muerto
+    finally:
+        for fd in (*hijo, w_estado):
+            os.close(fd)
+    pid = int.from_bytes(_leer_exacto(r_estado, 8), "little")
+    if not pid:
+        for fd in (*padre, r_estado):
+            os.close(fd)
+        _servidor.pop("socket").close()  # el próximo trabajo arranca otro
+        raise RuntimeError("el servidor fork no responde")
+    os.set_blocking(r_estado, False)
+    t = _trabajo(pid, padre, stdin)
+    t["estado_fd"] = r_estado
+    t["_estado"] = b""
+    return t
+
+def _cerrar_fd(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+def _matar(t):
+    # El hijo es líder de su grupo: se mata el grupo entero. Si el servidor
+    # fork ya lo recogió, ya mató también el grupo
+    if "_uso" in t:
+        return
+    for matar, objetivo in ((os.killpg, t["pid"]), (os.kill, t["pid"])):
+        try:
+            matar(objetivo, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+def _detener(sel, t, motivo, valor=True):
+    # Mata el hijo en cuanto se sabe su resultado y deja de atender sus tuberías
+    t[motivo] = valor
+    _matar(t)
+    for nombre in ("stdin", "stdout", "stderr"):
+        fd = t[nombre]
+        if fd in sel.get_map():
+            sel.unregister(fd)
+            _cerrar_fd(fd)
+
+def supervisar(trabajos, max_bytes=MAX_OUTPUT_BYTES):
+    sel = selectors.DefaultSelector()
+    for t in trabajos:
+        t["_buf"] = {"stdout": [], "stderr": []}
+        t["_bytes"] = 0
+        t["_abiertos"] = 2
+        for nombre in ("stdout", "stderr"):
+            sel.register(t[nombre], selectors.EVENT_READ, (t, nombre))
+        if t["entrada"]:
+            os.set_blocking(t["stdin"], False)
+            sel.register(t["stdin"], selectors.EVENT_WRITE, (t, "stdin"))
+        else:
+            _cerrar_fd(t["stdin"])
+
+    while sel.get_map():
+        ahora = time.monotonic()
+        activos = {id(k.data[0]): k.data[0] for k in sel.get_map().values()}
+        for t in activos.values():
+            if t["_limite"] <= ahora:
+                _detener(sel, t, "timeout")
+        if not sel.get_map():
+            break
+        # Si el proceso principal ya terminó, sus descendientes sobran: se mata
+        # el grupo y las tuberías que tuvieran abiertas llegan a EOF
+        for t in activos.values():
+            if not t.get("_grupo_matado") and _ha_terminado(t):
+                t["_grupo_matado"] = True
+                _matar(t)
+        restante = min(t["_limite"] for t in activos.values() if not t.get("timeout")) - ahora
+        for key, _ in sel.select(min(max(restante, 0), 0.05)):
+            t, nombre = key.data
+            if key.fd not in sel.get_map():
+                continue  # el trabajo se detuvo en este mismo ciclo
+            if nombre == "stdin":
+                try:
+                    n = os.write(key.fd, t["entrada"][:1 << 16])
+                    t["entrada"] = t["entrada"][n:]
+                except BlockingIOError:
+                    continue
+                except BrokenPipeError:
+                    t["entrada"] = b""
+                if not t["entrada"]:
+                    sel.unregister(key.fd)
+                    _cerrar_fd(key.fd)
+                continue
+            datos = os.read(key.fd, 1 << 16)
+            if not datos:
+                sel.unregister(key.fd)
+                _cerrar_fd(key.fd)
+                t["_abiertos"] -= 1
+                if not t["_abiertos"]:
+                    t["_fin"] = time.monotonic()
+                continue
+            # La salida nunca se acumula por encima de max_bytes
+            if t["_bytes"] + len(datos) > max_bytes:
+                datos = datos[:max_bytes - t["_bytes"]]
+                t["_buf"][nombre].append(datos)
+                _detener(sel, t, "limite_salida")
+                continue
+            t["_bytes"] += len(datos)
+            t["_buf"][nombre].append(datos)
+            if nombre == "stdout" and "vigilante" in t:
+                diferencia = t["vigilante"](t["_decoder"].decode(datos))
+                if diferencia is not None:
+                    _detener(sel, t, "divergencia", diferencia)
+    sel.close()
+
+    return [_recoger(t) for t in trabajos]
+
+def _ha_terminado(t):
+    if "estado_fd" in t:
+        return _leer_estado(t)
+    # Sin recogerlo: mientras sea zombi su grupo sigue existiendo para killpg
+    return os.waitid(os.P_PID, t["pid"], os.WEXITED | os.WNOHANG | os.WNOWAIT) is not None
+
+def _leer_estado(t, bloquear=False):
+    # Backend fork: el servidor escribe el estado y el consumo del hijo en la
+    # tubería de estado al recogerlo y la cierra. Sin nada escrito (el
+    # servidor murió) el hijo cuenta como matado
+    if "_uso" in t:
+        return True
+    fd = t["estado_fd"]
+    os.set_blocking(fd, bloquear)
+    while True:
+        try:
+            datos = os.read(fd, 4096)
+        except BlockingIOError:
+            return False
+        if not datos:
+            break
+        t["_estado"] += datos
+    os.close(fd)
+    try:
+        t["_uso"] = marshal.loads(t["_estado"])
+    except (ValueError, EOFError, TypeError):
+        t["_uso"] = dict.fromkeys(_preludio["modulo"].USO_CAMPOS, 0)
+        t["_uso"]["estado"] = -signal.SIGKILL
+    return True
+
+def _recoger(t):
+    # Espera al hijo sin pasar de su límite de tiempo, mata a los descendientes
+    # que queden en su grupo y recoge su consumo de recursos
+    espera = 0.0002
+    while not _ha_terminado(t):
+        if time.monotonic() >= t["_limite"]:
+            t["timeout"] = True
+            break
+        time.sleep(espera)
+        espera = min(espera * 2, 0.005)
+    _matar(t)
+    if "estado_fd" in t:
+        _leer_estado(t, bloquear=True)
+        uso = types.SimpleNamespace(**t["_uso"])
+        estado = uso.estado
+    else:
+        _, status, uso = os.wait4(t["pid"], 0)
+        estado = os.waitstatus_to_exitcode(status)
+    if "proc" in t:
+        t["proc"].returncode = estado
+    rss = uso.ru_maxrss if sys.platform == "darwin" else uso.ru_maxrss * 1024
+    recursos = {
+        "cpu_usuario": uso.ru_utime,
+        "cpu_sistema": uso.ru_stime,
+        "max_rss": rss,
+        "bloques_leidos": uso.ru_inblock,
+        "bloques_escritos": uso.ru_oublock,
+        "cambios_contexto_voluntarios": uso.ru_nvcsw,
+        "cambios_contexto_involuntarios": uso.ru_nivcsw,
+    }
+    return {
+        "stdout": _salida_texto(b"".join(t["_buf"]["stdout"])),
+        "stderr": _salida_texto(b"".join(t["_buf"]["stderr"])),
+        "estado": estado,
+        "timeout": t.get("timeout", False) or estado == -signal.SIGXCPU,
+        "limite_salida": t.get("limite_salida", False),
+        "divergencia": t.get("divergencia"),
+        "cpu": uso.ru_utime + uso.ru_stime,
+        "max_rss": rss,
+        "tiempo": t.get("_fin", time.monotonic()) - t["_inicio"],
+        "recursos": recursos,
+    }
+
+def coste(r):
+    return {"cpu": r["cpu"], "max_rss": r["max_rss"], "tiempo": r["tiempo"]}
+
+def limites_alumno(coste_patron):
+    if not coste_patron:
+        return {"pared": TIMEOUT}
+    cpu = min(LIMITE_PARED_MAX, max(LIMITE_CPU_MIN, LIMITE_FACTOR * coste_patron["cpu"]))
+    pared = min(LIMITE_PARED_MAX, max(LIMITE_PARED_MIN, LIMITE_FACTOR * coste_patron["tiempo"], cpu))
+    memoria = max(LIMITE_MEM_MIN, LIMITE_MEM_FACTOR * coste_patron["max_rss"])
+    return {"cpu": cpu, "pared": pared, "memoria": memoria}
 
 def delete_if_exists(path):
     if os.path.exists(path):
@@ -37,34 +400,546 @@ def read_text_file(path):
         data = data[:MAX_CHARS] + "\n...[TRUNCADO]..."
     return data
 
-def read_file_bytes(path):
-    if not os.path.exists(path):
-        return None
+def capturar_fichero(path, esperado=None):
+    # Una sola pasada por un fichero de salida: vista previa como la de
+    # read_text_file, sha256 y tamaño. "esperado" es la ruta del fichero del
+    # patrón o su captura; entonces se compara por bloques y se deja de leer en
+    # la primera diferencia (la vista previa nunca pasa de MAX_CHARS).
+    captura = {"texto": "[NO EXISTE]", "sha256": None, "tamano": None, "igual": None}
+    otro = None
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        f = None
+    try:
+        if isinstance(esperado, str):
+            try:
+                otro = open(esperado, "rb")
+            except FileNotFoundError:
+                esperado = {"sha256": None, "tamano": None}
+        if f is None:
+            if esperado is not None:
+                captura["igual"] = otro is None and esperado["sha256"] is None
+            return captura
+
+        captura["tamano"] = os.fstat(f.fileno()).st_size
+        if otro is not None:
+            igual = os.fstat(otro.fileno()).st_size == captura["tamano"]
+        elif esperado is not None:
+            igual = esperado["tamano"] == captura["tamano"]
+        else:
+            igual = None
+        h = hashlib.sha256() if otro is None and igual is not False else None
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder("utf8")(errors="replace"), translate=True
+        )
+        partes = []
+        caracteres = 0
+        while True:
+            previa = caracteres <= MAX_CHARS
+            if not previa and h is None and not (otro is not None and igual):
+                break
+            bloque = f.read(1 << 16)
+            if previa:
+                texto = decoder.decode(bloque, final=not bloque)
+                partes.append(texto)
+                caracteres += len(texto)
+            if not bloque:
+                break
+            if h is not None:
+                h.update(bloque)
+            if otro is not None and igual and otro.read(len(bloque)) != bloque:
+                igual = False
+
+        texto = "".join(partes)
+        if len(texto) > MAX_CHARS:
+            texto = texto[:MAX_CHARS] + "\n...[TRUNCADO]..."
+        captura["texto"] = texto
+        if h is not None:
+            captura["sha256"] = h.hexdigest()  # solo se para antes del final sin hash
+        if igual and otro is None and esperado is not None:
+            igual = captura["sha256"] == esperado["sha256"]
+        captura["igual"] = igual
+        return captura
+    finally:
+        for g in (f, otro):
+            if g is not None:
+                g.close()
+
+def sha256_file(path):
+    h = hashlib.sha256()
     with open(path, "rb") as f:
-        return f.read()
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# =========================================================
+# Caché en disco (LRU acotada por tamaño)
+# =========================================================
+
+def cache_ruta(espacio, clave):
+    return os.path.join(CACHE_DIR, espacio, clave)
+
+def cache_leer(espacio, clave):
+    if not CACHE_DIR:
+        return None
+    ruta = cache_ruta(espacio, clave)
+    try:
+        with open(ruta, "rb") as f:
+            datos = f.read()
+        os.utime(ruta)  # el mtime marca el último uso (LRU)
+        return datos
+    except OSError:
+        return None
+
+def cache_escribir(espacio, clave, datos, max_bytes=CACHE_MAX_BYTES):
+    if not CACHE_DIR or len(datos) > max_bytes:
+        return
+    ruta = cache_ruta(espacio, clave)
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(ruta), prefix=".tmp_")
+        with os.fdopen(fd, "wb") as f:
+            f.write(datos)
+        os.replace(tmp, ruta)
+        cache_recortar(espacio, max_bytes)
+    except OSError:
+        pass
+
+def cache_enlazar(espacio, clave, destino):
+    # Materializa una entrada en "destino" con un enlace duro (o una copia si
+    # no se puede enlazar). "destino" no debe existir: escribir encima de un
+    # enlace modificaría la entrada de la caché.
+    if not CACHE_DIR:
+        return False
+    ruta = cache_ruta(espacio, clave)
+    try:
+        os.utime(ruta)
+        try:
+            os.link(ruta, destino)
+        except OSError:
+            if not os.path.exists(ruta):
+                return False
+            shutil.copyfile(ruta, destino)
+        return True
+    except OSError:
+        return False
+
+def cache_escribir_fichero(espacio, clave, origen, max_bytes=CACHE_MAX_BYTES):
+    # Como cache_escribir, pero guarda un fichero existente sin leerlo en memoria
+    if not CACHE_DIR:
+        return
+    ruta = cache_ruta(espacio, clave)
+    try:
+        if os.path.getsize(origen) > max_bytes:
+            return
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = os.path.join(os.path.dirname(ruta), f".tmp_{os.getpid()}_{clave}")
+        delete_if_exists(tmp)
+        try:
+            os.link(origen, tmp)
+        except OSError:
+            shutil.copyfile(origen, tmp)
+        os.replace(tmp, ruta)
+        cache_recortar(espacio, max_bytes)
+    except OSError:
+        pass
+
+def cache_recortar(espacio, max_bytes=CACHE_MAX_BYTES):
+    entradas = []
+    total = 0
+    with os.scandir(os.path.join(CACHE_DIR, espacio)) as it:
+        for e in it:
+            if e.name.startswith(".tmp_"):
+                continue
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            entradas.append((st.st_mtime_ns, st.st_size, e.path))
+            total += st.st_size
+    entradas.sort()
+    for _, size, path in entradas:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+# =========================================================
+# Sandbox: instantánea de los adjuntos y restauración incremental
+# =========================================================
+
+# mtime con el que se marcan las copias: cualquier escritura lo cambia
+_MTIME_INTACTO = 0
+
+_sandbox = {}
+_raiz_sandbox = {}
+_copiados = {}
+_instantanea = {"version": 0, "ficheros": {}}
+
+def directorio_sandbox(nombre):
+    # Todos cuelgan de un directorio por ejecución, coderunner_<pid>_*. Si el
+    # corrector muere sin pasar por atexit (SIGKILL por tiempo en Jobe o en
+    # recalificar) queda en /dev/shm hasta que lo barre otra ejecución
+    if nombre not in _sandbox:
+        if not _raiz_sandbox:
+            base = SANDBOX_DIR or os.getcwd()
+            barrer_sandbox(base)
+            atexit.register(limpiar_sandbox)
+            _raiz_sandbox["dir"] = tempfile.mkdtemp(prefix=f"coderunner_{os.getpid()}_", dir=base)
+        _sandbox[nombre] = os.path.join(_raiz_sandbox["dir"], nombre)
+        os.mkdir(_sandbox[nombre])
+    return _sandbox[nombre]
+
+def limpiar_sandbox():
+    if _raiz_sandbox:
+        shutil.rmtree(_raiz_sandbox.pop("dir"), ignore_errors=True)
+    _sandbox.clear()
+    _copiados.clear()
+
+_sandbox_re = re.compile(r"coderunner_(\d+)_\w+")
+# Directorios con el formato anterior (uno por nombre, sin pid): se borran
+# cuando ya no puede estar usándolos ninguna corrección
+_sandbox_anterior_re = re.compile(r"coderunner_(?:instantanea|patron|alumno|modulos)_\w+")
+SANDBOX_ANTERIOR_EDAD = 3600
+
+def barrer_sandbox(base):
+    # Borra los directorios de ejecución de este usuario en "base" cuyo
+    # proceso ya no existe
+    try:
+        entradas = list(os.scandir(base))
+    except OSError:
+        return
+    for e in entradas:
+        m = _sandbox_re.fullmatch(e.name)
+        if not (m or _sandbox_anterior_re.fullmatch(e.name)):
+            continue
+        try:
+            st = e.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+            continue
+        if m is None:
+            abandonado = time.time() - st.st_mtime > SANDBOX_ANTERIOR_EDAD
+        elif int(m.group(1)) == os.getpid():
+            abandonado = True  # otra ejecución con nuestro pid: la nuestra aún no existe
+        else:
+            abandonado = not _proceso_vivo(int(m.group(1)))
+        if abandonado:
+            shutil.rmtree(e.path, ignore_errors=True)
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # existe, pero es de otro usuario
+    return True
+
+def crear_instantanea(attach_list, seed):
+    # Baraja los adjuntos originales directamente en la instantánea, sin
+    # tocar los del directorio actual
+    d = directorio_sandbox("instantanea")
+    previos = _instantanea["ficheros"]
+    ficheros = {}
+    for fn in attach_list:
+        if not os.path.exists(fn):
+            continue
+        if fn in previos and previos[fn][0] == seed:
+            ficheros[fn] = previos[fn]
+            continue
+        destino = os.path.join(d, fn)
+        delete_if_exists(destino)  # puede ser un enlace a la caché
+        clave = clave_barajado(fn, seed)
+        if not cache_enlazar("barajado", clave, destino):
+            barajar_fichero(fn, salida=destino, seed=seed)
+            cache_escribir_fichero("barajado", clave, destino, CACHE_BARAJADO_MAX_BYTES)
+        _instantanea["version"] += 1
+        ficheros[fn] = (seed, _instantanea["version"])
+    _instantanea["ficheros"] = ficheros
+    return {"dir": d, "ficheros": {fn: v for fn, (_, v) in ficheros.items()}}
+
+def _borrar(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+
+def restaurar_sandbox(destino, instantanea):
+    # Deja "destino" igual que la instantánea copiando solo lo que ha cambiado
+    copiados = _copiados.setdefault(destino, {})
+    ficheros = instantanea["ficheros"]
+    with os.scandir(destino) as it:
+        sobrantes = [e.path for e in it if e.name not in ficheros]
+    for path in sobrantes:
+        _borrar(path)
+
+    for fn, version in ficheros.items():
+        dst = os.path.join(destino, fn)
+        try:
+            st = os.lstat(dst)
+            actual = (version, st.st_ino, st.st_size, st.st_mtime_ns)
+        except FileNotFoundError:
+            actual = None
+        if actual is not None and copiados.get(fn) == actual:
+            continue
+        if actual is not None:
+            _borrar(dst)
+        shutil.copyfile(os.path.join(instantanea["dir"], fn), dst)
+        os.utime(dst, ns=(_MTIME_INTACTO, _MTIME_INTACTO))
+        st = os.lstat(dst)
+        copiados[fn] = (version, st.st_ino, st.st_size, st.st_mtime_ns)
 
 # =========================================================
 # Comparación flexible de stdout
 # =========================================================
 
+_linea_re = re.compile(r"([^\r\n]*)(?:\r\n|\r|\n)|([^\r\n]+)$")
+_token_re = re.compile(r"\S+")
+
+def _lineas(s):
+    # Líneas de "s" con cualquier fin de línea, sin partir el texto de una vez
+    for m in _linea_re.finditer(s or ""):
+        yield m.group(m.lastindex)
+
+def _lineas_normalizadas(s):
+    # Una pasada: espacios normalizados y sin líneas vacías al principio ni al
+    # final (las de en medio solo salen si después hay algo más)
+    blancos = 0
+    empezado = False
+    for ln in _lineas(s):
+        ln = _normalizar_linea(ln)
+        if ln == "":
+            if empezado:
+                blancos += 1
+            continue
+        empezado = True
+        for _ in range(blancos):
+            yield ""
+        blancos = 0
+        yield ln
+
 def normalize_stdout(s):
-    s = (s or "").replace("\r\n", "\n").replace("\r", "\n")
-    lines = [ln.rstrip() for ln in s.split("\n")]
-    while lines and lines[0] == "":
-        lines.pop(0)
-    while lines and lines[-1] == "":
-        lines.pop()
-    lines = [_ws_re.sub(" ", ln) for ln in lines]
-    return "\n".join(lines)
+    return "\n".join(_lineas_normalizadas(s))
+
+def _normalizar_linea(ln):
+    return _ws_re.sub(" ", ln.rstrip())
+
+_FIN = object()
+
+def _secuencias_iguales(a, b, igual=None):
+    # Compara dos iterables elemento a elemento y para en la primera diferencia
+    for x, y in itertools.zip_longest(a, b, fillvalue=_FIN):
+        if x is _FIN or y is _FIN:
+            return False
+        if x != y and (igual is None or not igual(x, y)):
+            return False
+    return True
+
+def _lineas_con_tolerancia(tolerancia):
+    def igual(esperada, obtenida):
+        te, to = esperada.split(), obtenida.split()
+        if len(te) != len(to):
+            return False
+        for x, y in zip(te, to):
+            if x == y:
+                continue
+            try:
+                fx, fy = float(x), float(y)
+            except ValueError:
+                return False
+            if not math.isclose(fx, fy, rel_tol=tolerancia, abs_tol=tolerancia):
+                return False
+        return True
+    return igual
+
+# Políticas de comparación de stdout. Cada una devuelve "igual(esperado,
+# obtenido)"; si compara línea a línea tras normalizar, "linea" para el
+# vigilante de PARADA_TEMPRANA (None = cualquier diferencia cuenta), y en
+# "diff" si tiene sentido mostrar un diff por líneas cuando falla.
+def _comparador_exacto():
+    return {"igual": lambda esperado, obtenido: esperado == obtenido, "vigilante": False, "diff": True}
+
+def _comparador_espacios():
+    def igual(esperado, obtenido):
+        return _secuencias_iguales(_lineas_normalizadas(esperado), _lineas_normalizadas(obtenido))
+    return {"igual": igual, "vigilante": True, "linea": None, "diff": True}
+
+def _comparador_reales(tolerancia="1e-6"):
+    linea = _lineas_con_tolerancia(float(tolerancia))
+    def igual(esperado, obtenido):
+        return _secuencias_iguales(_lineas_normalizadas(esperado), _lineas_normalizadas(obtenido), linea)
+    return {"igual": igual, "vigilante": True, "linea": linea, "diff": True}
+
+def _comparador_desordenado():
+    def igual(esperado, obtenido):
+        return collections.Counter(_lineas_normalizadas(esperado)) == collections.Counter(_lineas_normalizadas(obtenido))
+    return {"igual": igual, "vigilante": False, "diff": False}
+
+def _comparador_tokens():
+    def igual(esperado, obtenido):
+        return _secuencias_iguales(
+            (m.group() for m in _token_re.finditer(esperado or "")),
+            (m.group() for m in _token_re.finditer(obtenido or ""))
+        )
+    return {"igual": igual, "vigilante": False, "diff": False}
+
+COMPARADORES = {
+    "exacta": _comparador_exacto,
+    "espacios": _comparador_espacios,
+    "reales": _comparador_reales,
+    "desordenada": _comparador_desordenado,
+    "tokens": _comparador_tokens,
+}
+COMPARACION_POR_DEFECTO = "espacios"
+
+@functools.lru_cache(maxsize=None)
+def comparador(politica=""):
+    # "politica" es el nombre y sus argumentos, p. ej. "reales 1e-4". Se
+    # construye una vez por pregunta y se reutiliza en todos los tests.
+    nombre, *args = (politica or COMPARACION_POR_DEFECTO).split()
+    if nombre not in COMPARADORES:
+        raise ValueError(f"Comparación desconocida: {nombre!r} (válidas: {', '.join(COMPARADORES)})")
+    try:
+        c = dict(COMPARADORES[nombre](*args))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Argumentos no válidos para la comparación {nombre!r}: {' '.join(args)!r}") from e
+    lento = c["igual"]
+    # Camino rápido común a todas: salidas idénticas
+    c["igual"] = lambda esperado, obtenido: esperado == obtenido or lento(esperado, obtenido)
+    return c
+
+def vigilante_stdout(esperado, politica=""):
+    # Compara en streaming con el mismo criterio que el comparador de la
+    # política (solo las que van línea a línea; con las demás devuelve None).
+    # Devuelve una función que recibe trozos de stdout y retorna la primera
+    # diferencia ({"linea", "esperado", "obtenido"}) o None.
+    c = comparador(politica)
+    if not c["vigilante"]:
+        return None
+    igual = c["linea"]
+    lineas_esp = list(_lineas_normalizadas(esperado))
+    estado = {"pendiente": "", "n": 0, "blancos": 0, "empezado": False}
+
+    def comprobar(ln):
+        n = estado["n"]
+        if n >= len(lineas_esp) or (lineas_esp[n] != ln and not (igual and igual(lineas_esp[n], ln))):
+            return {
+                "linea": n + 1,
+                "esperado": lineas_esp[n] if n < len(lineas_esp) else None,
+                "obtenido": ln,
+            }
+        estado["n"] = n + 1
+        return None
+
+    def alimentar(texto):
+        buf = estado["pendiente"] + texto
+        resto = ""
+        if buf.endswith("\r"):
+            buf, resto = buf[:-1], "\r"  # puede ser la mitad de un \r\n
+        buf = buf.replace("\r\n", "\n").replace("\r", "\n")
+        *completas, ultima = buf.split("\n")
+        estado["pendiente"] = ultima + resto
+        for ln in completas:
+            ln = _normalizar_linea(ln)
+            if ln == "":
+                # Las líneas vacías solo cuentan si después hay algo más
+                if estado["empezado"]:
+                    estado["blancos"] += 1
+                continue
+            estado["empezado"] = True
+            for _ in range(estado["blancos"]):
+                diferencia = comprobar("")
+                if diferencia:
+                    return diferencia
+            estado["blancos"] = 0
+            diferencia = comprobar(ln)
+            if diferencia:
+                return diferencia
+        return None
+
+    return alimentar
+
+def bloque_diferencias(esperado, obtenido):
+    # Diff por líneas (normalizadas) alrededor de la primera diferencia. Las
+    # líneas se normalizan sobre la marcha hasta la primera distinta y desde
+    # ahí solo DIFF_VENTANA más, y difflib trabaja sobre sus hashes: el coste
+    # no depende del tamaño de las salidas. "" si no hay líneas distintas.
+    ga = _lineas_normalizadas(esperado)
+    gb = _lineas_normalizadas(obtenido)
+    previas = collections.deque(maxlen=DIFF_CONTEXTO)
+    i = 0
+    for x, y in itertools.zip_longest(ga, gb, fillvalue=_FIN):
+        if x != y:
+            break
+        previas.append(x)
+        i += 1
+    else:
+        return ""
+
+    a = [] if x is _FIN else [x]
+    b = [] if y is _FIN else [y]
+    a.extend(itertools.islice(ga, DIFF_VENTANA - len(a)))
+    b.extend(itertools.islice(gb, DIFF_VENTANA - len(b)))
+    cortado = next(ga, _FIN) is not _FIN or next(gb, _FIN) is not _FIN
+
+    lineas = [f"  {x}" for x in previas]
+    emparejador = difflib.SequenceMatcher(None, [hash(x) for x in a], [hash(x) for x in b], autojunk=False)
+    opcodes = emparejador.get_opcodes()
+    for k, (op, a1, a2, b1, b2) in enumerate(opcodes):
+        if op == "equal":
+            iguales = a[a1:a2]
+            if k == len(opcodes) - 1:
+                iguales = iguales[:DIFF_CONTEXTO]
+            elif len(iguales) > 2 * DIFF_CONTEXTO:
+                iguales = iguales[:DIFF_CONTEXTO] + ["..."] + iguales[-DIFF_CONTEXTO:]
+            lineas.extend(f"  {x}" for x in iguales)
+        else:
+            lineas.extend(f"- {x}" for x in a[a1:a2])
+            lineas.extend(f"+ {x}" for x in b[b1:b2])
+        if len(lineas) > DIFF_MAX_LINEAS:
+            break
+    if len(lineas) > DIFF_MAX_LINEAS or cortado:
+        lineas = lineas[:DIFF_MAX_LINEAS] + ["..."]
+    return block(
+        f"Diferencias con la salida esperada (desde la línea {i + 1}; - esperado, + obtenido)",
+        "\n".join(lineas)
+    )
+
+def bloque_divergencia(d):
+    esperado = "(fin de la salida)" if d["esperado"] is None else d["esperado"]
+    return block(
+        "Ejecución detenida en la primera diferencia",
+        f"Línea {d['linea']}\n"
+        f"Esperado: {esperado}\n"
+        f"Obtenido: {d['obtenido']}"
+    )
 
 # =========================================================
 # HTML helpers
 # =========================================================
 
+# Caracteres de contenido que se escapan como mucho en todo el informe (todos
+# los tests de la invocación); lo que no cabe se recorta antes de escapar
+_presupuesto_html = {"restante": HTML_MAX_CHARS}
+
+def reiniciar_presupuesto_html():
+    _presupuesto_html["restante"] = HTML_MAX_CHARS
+
 def block(title, content):
+    content = (content or "").rstrip()
+    disponible = _presupuesto_html["restante"]
+    if len(content) > disponible:
+        content = content[:disponible] + "\n...[TRUNCADO: el informe ha alcanzado su tamaño máximo]..."
+    _presupuesto_html["restante"] = max(0, disponible - len(content))
     return (
         f"<strong>{html.escape(title)}</strong>\n"
-        f"<pre>{html.escape((content or '').rstrip())}</pre>\n"
+        f"<pre>{html.escape(content)}</pre>\n"
     )
 
 def mostrar_test_sin_print(testcode):
@@ -73,10 +948,8 @@ def mostrar_test_sin_print(testcode):
         return s[len("print("):-1].strip()
     return s
 
-def construir_html(titulo, testcode, stdin, ficheros_iniciales, stdout, ficheros_finales):
+def html_contexto(testcode, stdin, ficheros_iniciales):
     parts = []
-    parts.append(f"<h3>{html.escape(titulo)}</h3>")
-
     parts.append("<h4>Contexto del test</h4>")
 
     if testcode.strip():
@@ -88,6 +961,10 @@ def construir_html(titulo, testcode, stdin, ficheros_iniciales, stdout, ficheros
     for fn, cont in ficheros_iniciales.items():
         parts.append(block(f"Fichero inicial: {fn}", cont))
 
+    return "\n".join(parts).rstrip()
+
+def html_resultado(stdout, ficheros_finales):
+    parts = []
     parts.append("<h4>Resultado de la ejecución</h4>")
 
     if stdout.strip():
@@ -111,174 +988,1031 @@ def stable_seed(test_fingerprint, student_code):
 # Barajado de ficheros
 # =========================================================
 
+# Tamaño (caracteres) hasta el que barajar_fichero trocea el fichero en listas
+# de celdas: es lo más rápido, pero el pico de memoria es ~25 veces el fichero
+BARAJAR_LISTAS_MAX = 4 * 1024 * 1024
+
 def barajar_fichero(entrada, salida=None, seed=None):
+    # Baraja por separado cada columna del CSV "entrada" (random.shuffle, de
+    # la primera a la última) y lo escribe en "salida" (por defecto, encima)
     if seed is not None:
         random.seed(seed)
 
     with open(entrada, "r", encoding="utf8", errors="replace") as f:
-        filas = [ln.rstrip().rstrip("\n") for ln in f]
+        texto = f.read()
 
-    while filas and filas[-1] == "":
-        filas.pop()
+    if len(texto) <= BARAJAR_LISTAS_MAX:
+        filas = _barajar_en_listas(texto)
+    else:
+        filas = _barajar_en_arrays(texto)
+    del texto
 
-    datos = [fila.split(",") for fila in filas if fila != ""]
-    if not datos:
+    if filas is None:
         if salida is None:
             salida = entrada + "_barajado"
         open(salida, "w").close()
         return salida
 
-    maxc = max(len(r) for r in datos)
-    for r in datos:
-        r.extend([""] * (maxc - len(r)))
+    if salida is None:
+        salida = entrada
+
+    with open(salida, "w", encoding="utf8") as g:
+        for fila in filas:
+            g.write(",".join(fila) + "\n")
 
-    columnas = list(zip(*datos))
-    columnas_barajadas = []
+    return salida
+
+def _barajar_en_listas(texto):
+    # Filas barajadas (tuplas de celdas), o None si no hay ninguna
+    datos = [fila.split(",") for fila in map(str.rstrip, texto.split("\n")) if fila]
+    if not datos:
+        return None
+    maxc = max(map(len, datos))
+    for fila in datos:
+        fila.extend([""] * (maxc - len(fila)))
+    columnas = [list(col) for col in zip(*datos)]
+    del datos
     for col in columnas:
-        col = list(col)
         random.shuffle(col)
-        columnas_barajadas.append(col)
+    return zip(*columnas)
 
-    filas_out = list(zip(*columnas_barajadas))
+def _barajar_en_arrays(texto):
+    # Lo mismo sin trocear el texto en listas: cada celda es una posición en
+    # un array y cada columna, un array de celdas barajado
+    from array import array
+    from itertools import accumulate, repeat
+    from operator import add, sub
 
-    if salida is None:
-        salida = entrada
+    tipo = "I" if len(texto) < 2**31 else "q"
+    inicios = array(tipo)  # inicio de cada celda; tras la última de cada fila, fin de fila + 1
+    primera = array(tipo)  # posición en "inicios" de la primera celda de cada fila
+    ncel = array(tipo)
+    pos = 0
+    while pos <= len(texto):
+        # Bloques de ~256 KiB de líneas enteras. Si ninguna está vacía ni
+        # acaba en blanco, las celdas son consecutivas y se miden de una vez
+        fin = texto.find("\n", pos + 2**18)
+        if fin == -1:
+            fin = len(texto)
+        bloque = texto[pos:fin]
+        lineas = bloque.split("\n")
+        if "" not in lineas and list(map(str.rstrip, lineas)) == lineas:
+            cuantas = array(tipo, map(add, map(str.count, lineas, repeat(",")), repeat(1)))
+            primera.extend(accumulate(cuantas[:-1], initial=len(inicios)))
+            ncel.extend(cuantas)
+            celdas = bloque.replace("\n", ",").split(",")
+            inicios.extend(accumulate(map(add, map(len, celdas), repeat(1)), initial=pos))
+        else:
+            for linea in lineas:
+                fila = linea.rstrip()
+                if fila:
+                    celdas = fila.split(",")
+                    primera.append(len(inicios))
+                    ncel.append(len(celdas))
+                    inicios.extend(accumulate(map(add, map(len, celdas), repeat(1)), initial=pos))
+                pos += len(linea) + 1
+        pos = fin + 1
 
-    with open(salida, "w", encoding="utf8") as g:
-        for r in filas_out:
-            g.write(",".join(r) + "\n")
+    if not primera:
+        return None
 
-    return salida
+    # Barajar los índices de celda consume los mismos números aleatorios que
+    # barajar las celdas. A las filas cortas les toca la celda vacía (0, 0)
+    vacia = len(inicios)
+    inicios.extend((0, 1))
+    n = len(primera)
+    minc = min(ncel)
+    columnas = []
+    for c in range(max(ncel)):
+        if c < minc:
+            col = list(map(add, primera, repeat(c)))
+        else:
+            col = [primera[k] + c if c < ncel[k] else vacia for k in range(n)]
+        random.shuffle(col)
+        col = array(tipo, col)
+        columnas.append(map(texto.__getitem__, map(
+            slice,
+            map(inicios.__getitem__, col),
+            map(sub, map(inicios.__getitem__, map(add, col, repeat(1))), repeat(1)),
+        )))
+    return zip(*columnas)
 
-def barajar_entradas_con_seed(attach_list, seed):
-    for fn in attach_list:
-        if not os.path.exists(fn):
-            continue
-        tmp = f".__tmp_barajado__{os.path.basename(fn)}"
-        barajar_fichero(fn, salida=tmp, seed=seed)
-        os.replace(tmp, fn)
+_sha_adjuntos = {}
+
+def sha256_adjunto(fn):
+    # El sha256 se recalcula solo si el fichero ha cambiado desde la última vez
+    st = os.stat(fn)
+    firma = (st.st_ino, st.st_size, st.st_mtime_ns)
+    if fn not in _sha_adjuntos or _sha_adjuntos[fn][0] != firma:
+        _sha_adjuntos[fn] = (firma, sha256_file(fn))
+    return _sha_adjuntos[fn][1]
+
+def clave_barajado(fn, seed):
+    # Contenido del adjunto + semilla + algoritmo (el de random.shuffle puede
+    # cambiar entre versiones de Python)
+    h = hashlib.sha256()
+    for parte in (sys.version, PRELUDIO_SRC, sha256_adjunto(fn), str(seed)):
+        h.update(hashlib.sha256(parte.encode("utf8")).digest())
+    return h.hexdigest()
 
 # =========================================================
-# Inyección para patrón y alumno
+# Preludio de patrón y alumno: módulo precompilado
 # =========================================================
 
-BARAJAR_SRC = """
-import random
+PRELUDIO_SRC = """
+# Módulo que importan los hijos: barajar_fichero, el lanzador de prog.py (el
+# mismo para los dos backends) y el servidor fork
+import random, sys, os, types, builtins, linecache, traceback, marshal
+import atexit, gc, math, resource
+
+# Tamaño (caracteres) hasta el que barajar_fichero trocea el fichero en listas
+# de celdas: es lo más rápido, pero el pico de memoria es ~25 veces el fichero
+BARAJAR_LISTAS_MAX = 4 * 1024 * 1024
+
 def barajar_fichero(entrada, salida=None, seed=None):
+    # Baraja por separado cada columna del CSV "entrada" (random.shuffle, de
+    # la primera a la última) y lo escribe en "salida" (por defecto, encima)
     if seed is not None:
         random.seed(seed)
+
     with open(entrada, "r", encoding="utf8", errors="replace") as f:
-        filas = [ln.rstrip().rstrip("\\n") for ln in f]
-    while filas and filas[-1] == "":
-        filas.pop()
-    datos = [fila.split(",") for fila in filas if fila != ""]
-    if not datos:
+        texto = f.read()
+
+    if len(texto) <= BARAJAR_LISTAS_MAX:
+        filas = _barajar_en_listas(texto)
+    else:
+        filas = _barajar_en_arrays(texto)
+    del texto
+
+    if filas is None:
         if salida is None:
             salida = entrada + "_barajado"
         open(salida, "w").close()
         return salida
-    maxc = max(len(r) for r in datos)
-    for r in datos:
-        r.extend([""] * (maxc - len(r)))
-    columnas = list(zip(*datos))
-    columnas_barajadas = []
-    for col in columnas:
-        col = list(col)
-        random.shuffle(col)
-        columnas_barajadas.append(col)
-    filas_out = list(zip(*columnas_barajadas))
+
     if salida is None:
         salida = entrada
+
     with open(salida, "w", encoding="utf8") as g:
-        for r in filas_out:
-            g.write(",".join(r) + "\\n")
+        for fila in filas:
+            g.write(",".join(fila) + "\\n")
+
     return salida
+
+def _barajar_en_listas(texto):
+    # Filas barajadas (tuplas de celdas), o None si no hay ninguna
+    datos = [fila.split(",") for fila in map(str.rstrip, texto.split("\\n")) if fila]
+    if not datos:
+        return None
+    maxc = max(map(len, datos))
+    for fila in datos:
+        fila.extend([""] * (maxc - len(fila)))
+    columnas = [list(col) for col in zip(*datos)]
+    del datos
+    for col in columnas:
+        random.shuffle(col)
+    return zip(*columnas)
+
+def _barajar_en_arrays(texto):
+    # Lo mismo sin trocear el texto en listas: cada celda es una posición en
+    # un array y cada columna, un array de celdas barajado
+    from array import array
+    from itertools import accumulate, repeat
+    from operator import add, sub
+
+    tipo = "I" if len(texto) < 2**31 else "q"
+    inicios = array(tipo)  # inicio de cada celda; tras la última de cada fila, fin de fila + 1
+    primera = array(tipo)  # posición en "inicios" de la primera celda de cada fila
+    ncel = array(tipo)
+    pos = 0
+    while pos <= len(texto):
+        # Bloques de ~256 KiB de líneas enteras. Si ninguna está vacía ni
+        # acaba en blanco, las celdas son consecutivas y se miden de una vez
+        fin = texto.find("\\n", pos + 2**18)
+        if fin == -1:
+            fin = len(texto)
+        bloque = texto[pos:fin]
+        lineas = bloque.split("\\n")
+        if "" not in lineas and list(map(str.rstrip, lineas)) == lineas:
+            cuantas = array(tipo, map(add, map(str.count, lineas, repeat(",")), repeat(1)))
+            primera.extend(accumulate(cuantas[:-1], initial=len(inicios)))
+            ncel.extend(cuantas)
+            celdas = bloque.replace("\\n", ",").split(",")
+            inicios.extend(accumulate(map(add, map(len, celdas), repeat(1)), initial=pos))
+        else:
+            for linea in lineas:
+                fila = linea.rstrip()
+                if fila:
+                    celdas = fila.split(",")
+                    primera.append(len(inicios))
+                    ncel.append(len(celdas))
+                    inicios.extend(accumulate(map(add, map(len, celdas), repeat(1)), initial=pos))
+                pos += len(linea) + 1
+        pos = fin + 1
+
+    if not primera:
+        return None
+
+    # Barajar los índices de celda consume los mismos números aleatorios que
+    # barajar las celdas. A las filas cortas les toca la celda vacía (0, 0)
+    vacia = len(inicios)
+    inicios.extend((0, 1))
+    n = len(primera)
+    minc = min(ncel)
+    columnas = []
+    for c in range(max(ncel)):
+        if c < minc:
+            col = list(map(add, primera, repeat(c)))
+        else:
+            col = [primera[k] + c if c < ncel[k] else vacia for k in range(n)]
+        random.shuffle(col)
+        col = array(tipo, col)
+        columnas.append(map(texto.__getitem__, map(
+            slice,
+            map(inicios.__getitem__, col),
+            map(sub, map(inicios.__getitem__, map(add, col, repeat(1))), repeat(1)),
+        )))
+    return zip(*columnas)
+
+def con_fichero(codigo, filename):
+    # El código cacheado no depende del sandbox en el que se compiló
+    consts = tuple(
+        con_fichero(c, filename) if isinstance(c, types.CodeType) else c
+        for c in codigo.co_consts
+    )
+    return codigo.replace(co_filename=filename, co_consts=consts)
+
+def ejecutar(code, codigo=None):
+    # Ejecuta "code" como el __main__ de "python -B prog.py" en el directorio
+    # actual, con random y barajar_fichero ya definidos. Devuelve el estado de salida.
+    filename = os.path.abspath("prog.py")
+    sys.argv = ["prog.py"]
+    sys.path[0] = os.getcwd()
+    lineas = code.splitlines(True)
+    if lineas and not lineas[-1].endswith("\\n"):
+        lineas[-1] += "\\n"  # como hace linecache con los ficheros
+    linecache.cache[filename] = (len(code), None, lineas, filename)
+    modulo = types.ModuleType("__main__")
+    modulo.__file__ = filename
+    modulo.__builtins__ = builtins
+    modulo.random = random
+    modulo.barajar_fichero = barajar_fichero
+    sys.modules["__main__"] = modulo
+
+    try:
+        if codigo is None:
+            codigo = compile(code, filename, "exec")
+        else:
+            codigo = con_fichero(codigo, filename)
+    except SyntaxError as e:
+        traceback.print_exception(type(e), e, None)
+        return 1
+    try:
+        exec(codigo, modulo.__dict__)
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException as e:
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        return 1
+    return 0
+
+def principal(ruta_codigo=""):
+    # Entrada del backend subprocess: lee prog.py y, si se indica, el código
+    # ya compilado (marshal) que dejó el corrector
+    with open("prog.py", encoding="utf8") as f:
+        code = f.read()
+    codigo = None
+    if ruta_codigo:
+        try:
+            with open(ruta_codigo, "rb") as f:
+                codigo = marshal.load(f)
+        except (OSError, ValueError, EOFError, TypeError):
+            codigo = None
+    sys.exit(ejecutar(code, codigo))
+
+def aplicar_limites(limites):
+    # Se ejecuta en el hijo: grupo de procesos propio (para matar también a los
+    # descendientes) y rlimits de CPU y memoria
+    os.setsid()
+    topes = (
+        (resource.RLIMIT_CPU, limites.get("cpu") and math.ceil(limites["cpu"])),
+        (resource.RLIMIT_AS, limites.get("memoria") and int(limites["memoria"])),
+    )
+    for recurso, valor in topes:
+        if not valor:
+            continue
+        _, duro = resource.getrlimit(recurso)
+        if duro != resource.RLIM_INFINITY:
+            valor = min(valor, duro)
+        blando = valor
+        if recurso == resource.RLIMIT_CPU and duro == resource.RLIM_INFINITY:
+            valor += 1  # SIGXCPU con el blando, SIGKILL un segundo después
+        resource.setrlimit(recurso, (blando, valor))
+
+def ejecutar_hijo(trabajo):
+    # Reproduce "python -B prog.py" en un hijo del servidor fork, sin escribir
+    # prog.py. No vuelve: termina con os._exit
+    estado = 1
+    try:
+        encoding = trabajo["encoding"]
+        sys.stdin = sys.__stdin__ = open(0, "r", encoding=encoding, closefd=False)
+        sys.stdout = sys.__stdout__ = open(
+            1, "w", buffering=1 if trabajo["por_lineas"] else -1,
+            encoding=encoding, closefd=False
+        )
+        sys.stderr = sys.__stderr__ = open(
+            2, "w", buffering=1, encoding=encoding,
+            errors="backslashreplace", closefd=False
+        )
+        sys.dont_write_bytecode = True
+        random.seed()
+        atexit._clear()
+        estado = ejecutar(trabajo["code"], trabajo["codigo"])
+        atexit._run_exitfuncs()
+        # Como al cerrar el intérprete: se vacía el __main__ del programa para
+        # que los ficheros que dejó abiertos se cierren (y escriban su búfer)
+        # antes de os._exit
+        modulo = sys.modules.pop("__main__", None)
+        if modulo is not None:
+            modulo.__dict__.clear()
+        del modulo
+        gc.collect()
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except BaseException:
+        pass
+    finally:
+        os._exit(estado)
+
+def _recibir_trabajo(conexion, socket):
+    # Un trabajo son 8 bytes con la longitud y el diccionario en marshal; sus
+    # descriptores (stdin, stdout, stderr y estado) llegan con los primeros
+    # bytes. None si el corrector cerró el socket.
+    cabecera, fds, _, _ = socket.recv_fds(conexion, 8, 4)
+    while cabecera and len(cabecera) < 8:
+        resto = conexion.recv(8 - len(cabecera))
+        if not resto:
+            break
+        cabecera += resto
+    if len(cabecera) < 8 or len(fds) != 4:
+        for fd in fds:
+            os.close(fd)
+        return None
+    datos = bytearray(int.from_bytes(cabecera, "little"))
+    vista = memoryview(datos)
+    while vista:
+        n = conexion.recv_into(vista)
+        if not n:
+            return None
+        vista = vista[n:]
+    return marshal.loads(datos), fds
+
+USO_CAMPOS = (
+    "ru_utime", "ru_stime", "ru_maxrss", "ru_inblock", "ru_oublock", "ru_nvcsw", "ru_nivcsw",
+)
+
+def _recoger_hijos(estados, signal):
+    # Mata el grupo de cada hijo que ha terminado (antes de recogerlo: mientras
+    # es zombi su grupo sigue existiendo) y escribe su estado y su consumo en
+    # la tubería de estado, que se cierra
+    while True:
+        try:
+            info = os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOHANG | os.WNOWAIT)
+        except ChildProcessError:
+            return
+        if info is None:
+            return
+        try:
+            os.killpg(info.si_pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        pid, status, uso = os.wait4(info.si_pid, 0)
+        fd = estados.pop(pid, None)
+        if fd is None:
+            continue
+        resultado = {campo: getattr(uso, campo) for campo in USO_CAMPOS}
+        resultado["estado"] = os.waitstatus_to_exitcode(status)
+        try:
+            os.write(fd, marshal.dumps(resultado))
+        except OSError:
+            pass
+        os.close(fd)
+
+def servidor(fd, precargados=()):
+    # Entrada del backend fork: un intérprete limpio, que solo ha importado
+    # este módulo y los precargados, recibe trabajos por el socket "fd" y
+    # ejecuta cada uno en un hijo. Por la tubería de estado del trabajo escribe
+    # el pid del hijo y, cuando termina, su estado y su consumo de recursos.
+    # Los hijos no heredan nada del corrector. Termina cuando se cierra el socket.
+    import importlib, selectors, signal, socket
+    for nombre in precargados:
+        try:
+            importlib.import_module(nombre)
+        except ImportError:
+            pass
+    conexion = socket.socket(fileno=fd)
+    aviso_r, aviso_w = os.pipe()
+    os.set_blocking(aviso_r, False)
+    os.set_blocking(aviso_w, False)
+    signal.set_wakeup_fd(aviso_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    sel = selectors.DefaultSelector()
+    sel.register(conexion, selectors.EVENT_READ)
+    sel.register(aviso_r, selectors.EVENT_READ)
+    estados = {}
+    gc.collect()
+    gc.freeze()  # los hijos no tocan (ni copian) los objetos ya cargados
+
+    while True:
+        for key, _ in sel.select():
+            if key.fileobj == aviso_r:
+                try:
+                    while os.read(aviso_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                _recoger_hijos(estados, signal)
+                continue
+            recibido = _recibir_trabajo(conexion, socket)
+            if recibido is None:
+                for pid in estados:
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except (ProcessLookupError, PermissionError):
+                        pass
+                return
+            trabajo, fds = recibido
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    signal.set_wakeup_fd(-1)
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    sel.close()
+                    conexion.close()
+                    for f in (aviso_r, aviso_w, *estados.values(), fds[3]):
+                        os.close(f)
+                    for destino, f in enumerate(fds[:3]):
+                        os.dup2(f, destino)
+                    for f in fds[:3]:
+                        os.close(f)
+                    del estados, recibido, fds, key
+                    os.chdir(trabajo["cwd"])
+                    aplicar_limites(trabajo["limites"])
+                except BaseException:
+                    traceback.print_exc()
+                    os._exit(1)
+                ejecutar_hijo(trabajo)
+            for f in fds[:3]:
+                os.close(f)
+            try:
+                os.write(fds[3], pid.to_bytes(8, "little"))
+            except OSError:
+                pass
+            estados[pid] = fds[3]
 """
 
+# Lo que ejecuta "python -B -c" en el backend subprocess: argv[1] es el
+# directorio del preludio y argv[2] el código compilado ("" si no hay)
+LANZADOR = (
+    "import sys; sys.path.insert(0, sys.argv[1]); import coderunner_preludio as p; "
+    "del sys.path[0]; p.principal(sys.argv[2])"
+)
+
+# Lo que ejecuta "python -B -c" para arrancar el servidor fork: argv[1] es el
+# directorio del preludio, argv[2] el socket y el resto, los módulos precargados
+SERVIDOR = (
+    "import sys; sys.path.insert(0, sys.argv[1]); import coderunner_preludio as p; "
+    "del sys.path[0]; p.servidor(int(sys.argv[2]), sys.argv[3:])"
+)
+
+_preludio = {}
+
+def modulo_preludio():
+    # Compila el preludio una vez por ejecución del corrector y lo ejecuta
+    # desde memoria. Para los hijos se escribe, con su .pyc, en un directorio
+    # propio de esta ejecución (0700, fuera de los de patrón y alumno): nunca
+    # se importa nada de un directorio compartido que un programa corregido
+    # antes haya podido modificar. -B impide escribir .pyc, no leerlos.
+    if not _preludio:
+        base = directorio_sandbox("modulos")
+        ruta = os.path.join(base, "coderunner_preludio.py")
+        codigo = compile(PRELUDIO_SRC, ruta, "exec", dont_inherit=True)
+        with open(ruta, "w", encoding="utf8") as f:
+            f.write(PRELUDIO_SRC)
+        # .pyc basado en hash sin comprobación del fuente (bits 0b01 de flags)
+        pyc = importlib.util.cache_from_source(ruta)
+        os.makedirs(os.path.dirname(pyc), exist_ok=True)
+        with open(pyc, "wb") as f:
+            f.write(importlib.util.MAGIC_NUMBER + (1).to_bytes(4, "little"))
+            f.write(importlib.util.source_hash(PRELUDIO_SRC.encode("utf8")))
+            f.write(marshal.dumps(codigo))
+        modulo = types.ModuleType("coderunner_preludio")
+        modulo.__file__ = ruta
+        exec(codigo, modulo.__dict__)
+        _preludio.update(modulo=modulo, dir=base)
+    return _preludio["modulo"]
+
+_compilados = {}
+
+def compilar_en_cache(code):
+    # Compila "code" una sola vez por ejecución del corrector. Devuelve
+    # (código, ruta) con el código en marshal en el directorio del preludio
+    # para el backend subprocess; (None, "") si no compila, para que el error
+    # lo dé el propio hijo. No se guarda en la caché de disco: se ejecutaría
+    # como patrón lo que hubiera escrito allí cualquier programa.
+    clave = hashlib.sha256((sys.version + "\0" + code).encode("utf8")).hexdigest()
+    if clave not in _compilados:
+        try:
+            codigo = compile(code, "prog.py", "exec", dont_inherit=True)
+        except (SyntaxError, ValueError):
+            return None, ""
+        ruta = ""
+        if BACKEND != "fork":
+            ruta = os.path.join(_preludio["dir"], clave + ".marshal")
+            with open(ruta, "wb") as f:
+                f.write(marshal.dumps(codigo))
+        _compilados[clave] = (codigo, ruta)
+    return _compilados[clave]
+
 # =========================================================
-# TEST PRINCIPAL
+# Caché de la ejecución del patrón
 # =========================================================
 
-def do_testing():
-    stdin = """{{ TEST.stdin | e('py') }}"""
-    testcode = """{{ TEST.testcode | e('py') }}"""
-    extra = """{{ TEST.extra | e('py') }}"""
+def clave_patron(answer, test, attach_list, base="."):
+    # "test" es (stdin, testcode, extra): cada parte se resume por separado
+    # para que no se confundan tests que solo difieren en dónde acaba cada una.
+    # La semilla no forma parte de la clave: su único efecto sobre el patrón
+    # es el contenido barajado de los adjuntos, que ya se incluye.
+    h = hashlib.sha256()
+    for parte in (sys.version, PRELUDIO_SRC, answer, *test):
+        h.update(hashlib.sha256(parte.encode("utf8")).digest())
+    for fn in attach_list:
+        path = os.path.join(base, fn)
+        h.update(fn.encode("utf8") + b"\0")
+        h.update(sha256_file(path).encode() if os.path.exists(path) else b"-")
+    return h.hexdigest()
+
+def patron_desde_cache(clave):
+    # Los ficheros de salida se guardan como su captura (vista previa, sha256
+    # y tamaño), no su contenido
+    datos = cache_leer("patron", clave)
+    if datos is None:
+        return None
+    try:
+        entrada = json.loads(datos)
+        ficheros = {}
+        for fn, f in entrada["ficheros"].items():
+            ficheros[fn] = {"texto": f["texto"], "sha256": f["sha256"], "tamano": f["tamano"]}
+        return entrada["stdout"], ficheros, entrada.get("coste")
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def patron_a_cache(clave, stdout, ficheros, coste_patron=None):
+    ficheros = {
+        fn: {"texto": f["texto"], "sha256": f["sha256"], "tamano": f["tamano"]}
+        for fn, f in ficheros.items()
+    }
+    datos = json.dumps({"stdout": stdout, "ficheros": ficheros, "coste": coste_patron})
+    cache_escribir("patron", clave, datos.encode("utf8"))
+
+# =========================================================
+# Caché de veredictos
+# =========================================================
+
+# Un envío idéntico a otro ya corregido (mismo código, misma versión de la
+# pregunta) recibe el mismo JSON sin ejecutar nada: la semilla sale del test
+# y del código del alumno, así que el resultado es el mismo. Si cambia la
+# pregunta (patrón, tests, adjuntos o parámetros), la plantilla o la
+# configuración que afecta a la nota, cambia la clave, y las entradas viejas
+# acaban saliendo de la LRU.
 
+_veredicto = {"estable": True}
+_fuente = {}
+
+def huella_plantilla():
+    # sha256 del fuente de este corrector ("" si no se puede leer)
+    if "huella" not in _fuente:
+        try:
+            with open(__file__, "rb") as f:
+                _fuente["huella"] = hashlib.sha256(f.read()).hexdigest()
+        except (NameError, OSError):
+            _fuente["huella"] = ""
+    return _fuente["huella"]
+
+def clave_veredicto(llamada, tests, attach_list, student_code, answer):
+    # "tests" es una tupla de textos, cada uno se resume por separado. None si
+    # no se debe usar la caché: con la traza en el resultado cada ejecución es
+    # distinta, y sin el fuente de la plantilla no se sabe qué versión corrige
+    if not (CACHE_DIR and CACHE_VEREDICTOS) or TRAZA_EN_RESULTADO or not huella_plantilla():
+        return None
+    _veredicto["estable"] = True
+    h = hashlib.sha256()
+    for parte in (
+        huella_plantilla(), sys.version, llamada, BACKEND, str(PARADA_TEMPRANA),
+        str(HTML_MAX_CHARS), str(MAX_OUTPUT_BYTES), str(LIMITE_MEM_MIN),
+        json.dumps(parametros_pregunta(), sort_keys=True), answer, student_code, *tests,
+    ):
+        h.update(hashlib.sha256(parte.encode("utf8")).digest())
+    for fn in attach_list:
+        h.update(fn.encode("utf8") + b"\0")
+        h.update(sha256_adjunto(fn).encode() if os.path.exists(fn) else b"-")
+    return h.hexdigest()
+
+def veredicto_desde_cache(clave):
+    datos = cache_leer("veredictos", clave) if clave else None
+    return datos.decode("utf8") if datos is not None else None
+
+def veredicto_a_cache(clave, salida):
+    if clave and _veredicto["estable"]:
+        cache_escribir("veredictos", clave, salida.encode("utf8"), CACHE_VEREDICTOS_MAX_BYTES)
+
+def anotar_estabilidad(r):
+    # Un timeout, una muerte por señal o un MemoryError dependen de la carga
+    # de la máquina y de los límites (que salen del coste medido del patrón):
+    # ese resultado no se guarda
+    if (r["timeout"]
+            or (r["estado"] < 0 and not r["limite_salida"] and not r["divergencia"])
+            or "MemoryError" in r["stderr"]):
+        _veredicto["estable"] = False
+
+# =========================================================
+# Traza de tiempos por fase
+# =========================================================
+
+_traza = None
+
+def marcar_fase(nombre):
+    # Atribuye a "nombre" el tiempo transcurrido desde la marca anterior
+    if _traza is None:
+        return
+    ahora = time.perf_counter()
+    anotar_fase(nombre, ahora - _traza["_t"])
+    _traza["_t"] = ahora
+
+def anotar_fase(nombre, segundos):
+    if _traza is not None:
+        _traza["fases"][nombre] = _traza["fases"].get(nombre, 0.0) + segundos
+
+def anotar_recursos(rol, r):
+    if _traza is not None:
+        _traza["recursos"][rol] = r["recursos"]
+
+def registrar_traza(traza):
+    if not TRAZA_FICHERO:
+        return
+    linea = json.dumps(traza) + "\n"
+    try:
+        with open(TRAZA_FICHERO, "a", encoding="utf8") as f:
+            f.write(linea)
+    except OSError:
+        pass
+
+# =========================================================
+# Métricas de recursos (Prometheus)
+# =========================================================
+
+METRICAS = (
+    # (nombre, tipo, ayuda)
+    ("coderunner_ejecuciones_total", "counter", "Programas ejecutados"),
+    ("coderunner_timeouts_total", "counter", "Ejecuciones que agotaron su límite de tiempo"),
+    ("coderunner_tiempo_segundos_total", "counter", "Tiempo de pared de las ejecuciones"),
+    ("coderunner_cpu_usuario_segundos_total", "counter", "CPU de usuario de los hijos"),
+    ("coderunner_cpu_sistema_segundos_total", "counter", "CPU de sistema de los hijos"),
+    ("coderunner_max_rss_bytes_sum", "counter", "Suma de los picos de memoria residente"),
+    ("coderunner_max_rss_bytes_max", "gauge", "Mayor pico de memoria residente observado"),
+    ("coderunner_bloques_leidos_total", "counter", "Bloques leídos de disco"),
+    ("coderunner_bloques_escritos_total", "counter", "Bloques escritos a disco"),
+    ("coderunner_cambios_contexto_voluntarios_total", "counter", "Cambios de contexto voluntarios"),
+    ("coderunner_cambios_contexto_involuntarios_total", "counter", "Cambios de contexto involuntarios"),
+)
+
+_metricas_pendientes = {}
+_metrica_re = re.compile(r'^(\w+)\{rol="(\w+)"\} (\S+)$')
+
+def anotar_metricas(rol, r):
+    if not METRICAS_FICHERO or r is None:
+        return
+    if not _metricas_pendientes:
+        atexit.register(volcar_metricas)
+    rec = r["recursos"]
+    m = _metricas_pendientes.setdefault(rol, {})
+    for nombre, valor in (
+        ("coderunner_ejecuciones_total", 1),
+        ("coderunner_timeouts_total", int(r["timeout"])),
+        ("coderunner_tiempo_segundos_total", r["tiempo"]),
+        ("coderunner_cpu_usuario_segundos_total", rec["cpu_usuario"]),
+        ("coderunner_cpu_sistema_segundos_total", rec["cpu_sistema"]),
+        ("coderunner_max_rss_bytes_sum", rec["max_rss"]),
+        ("coderunner_bloques_leidos_total", rec["bloques_leidos"]),
+        ("coderunner_bloques_escritos_total", rec["bloques_escritos"]),
+        ("coderunner_cambios_contexto_voluntarios_total", rec["cambios_contexto_voluntarios"]),
+        ("coderunner_cambios_contexto_involuntarios_total", rec["cambios_contexto_involuntarios"]),
+    ):
+        m[nombre] = m.get(nombre, 0) + valor
+    clave = "coderunner_max_rss_bytes_max"
+    m[clave] = max(m.get(clave, 0), rec["max_rss"])
+
+def volcar_metricas():
+    # Suma lo pendiente a lo que ya hay en el fichero, bajo un cerrojo para
+    # que varios correctores puedan compartirlo
+    if not _metricas_pendientes:
+        return
+    try:
+        with open(METRICAS_FICHERO + ".lock", "w") as cerrojo:
+            fcntl.flock(cerrojo, fcntl.LOCK_EX)
+            valores = {}
+            try:
+                with open(METRICAS_FICHERO, encoding="utf8") as f:
+                    for linea in f:
+                        m = _metrica_re.match(linea.strip())
+                        if m:
+                            valores[(m.group(1), m.group(2))] = float(m.group(3))
+            except FileNotFoundError:
+                pass
+
+            for rol, m in _metricas_pendientes.items():
+                for nombre, valor in m.items():
+                    previo = valores.get((nombre, rol), 0)
+                    if nombre.endswith("_max"):
+                        valores[(nombre, rol)] = max(previo, valor)
+                    else:
+                        valores[(nombre, rol)] = previo + valor
+
+            lineas = []
+            for nombre, tipo, ayuda in METRICAS:
+                lineas.append(f"# HELP {nombre} {ayuda}")
+                lineas.append(f"# TYPE {nombre} {tipo}")
+                for (n, rol), valor in sorted(valores.items()):
+                    if n == nombre:
+                        # sin llaves dobles: la plantilla pasa por Twig
+                        lineas.append(nombre + '{rol="' + rol + '"} ' + f"{valor:.15g}")
+            tmp = METRICAS_FICHERO + ".tmp"
+            with open(tmp, "w", encoding="utf8") as f:
+                f.write("\n".join(lineas) + "\n")
+            os.replace(tmp, METRICAS_FICHERO)
+    except OSError:
+        pass
+    _metricas_pendientes.clear()
+
+# =========================================================
+# TEST PRINCIPAL
+# =========================================================
+
+def datos_pregunta():
     attachments = """{{ ATTACHMENTS | e('py') }}""".strip()
     attach_list = [a.strip() for a in attachments.split(",") if a.strip()]
+    student_code = """{{ STUDENT_ANSWER | e('py') }}"""
+    answer = """{{ QUESTION.answer | e('py') }}"""
+    return attach_list, student_code, answer
 
-    outfiles = [x.strip() for x in extra.splitlines() if x.strip()]
+_parametros = {}
 
-    student_code = """{{ STUDENT_ANSWER | e('py') }}"""
+def parametros_pregunta():
+    # Parámetros de plantilla de la pregunta ({} si no tiene)
+    if "valor" not in _parametros:
+        try:
+            valor = json.loads("""{{ QUESTION.parameters | json_encode | e('py') }}""" or "{}")
+        except ValueError:
+            valor = {}
+        _parametros["valor"] = valor if isinstance(valor, dict) else {}
+    return _parametros["valor"]
+
+def leer_extra(extra):
+    # "extra" lista los ficheros de salida, uno por línea. Una línea
+    # "comparacion: <política>" elige la comparación de stdout de ese test;
+    # si no la hay se usa el parámetro "comparacion" de la pregunta.
+    outfiles = []
+    politica = ""
+    for x in extra.splitlines():
+        x = x.strip()
+        if x.lower().startswith("comparacion:"):
+            politica = x.split(":", 1)[1].strip()
+        elif x:
+            outfiles.append(x)
+    return outfiles, politica or str(parametros_pregunta().get("comparacion") or "")
+
+def evaluar_test(stdin, testcode, extra, attach_list, student_code, answer):
+    global _traza
+    if not (TRAZA_FICHERO or TRAZA_EN_RESULTADO):
+        return _evaluar_test(stdin, testcode, extra, attach_list, student_code, answer)
+
+    inicio = time.perf_counter()
+    _traza = {"_t": inicio, "fases": {}, "recursos": {}}
+    try:
+        r = _evaluar_test(stdin, testcode, extra, attach_list, student_code, answer)
+    finally:
+        fases, recursos, _traza = _traza["fases"], _traza["recursos"], None
+    traza = {
+        "ts": time.time(),
+        "backend": BACKEND,
+        "total": time.perf_counter() - inicio,
+        "fraction": r["fraction"],
+        "fases": fases,
+        "recursos": recursos,
+    }
+    registrar_traza(traza)
+    if TRAZA_EN_RESULTADO:
+        r["traza"] = traza
+    return r
+
+def _evaluar_test(stdin, testcode, extra, attach_list, student_code, answer):
+    outfiles, politica = leer_extra(extra)
+    try:
+        comparacion = comparador(politica)
+    except ValueError as e:
+        # Política desconocida o mal escrita: es un fallo de la pregunta, no
+        # del alumno
+        return {"expected": "", "got": block("Error en la pregunta", str(e)), "fraction": 0}
 
     test_fingerprint = stdin + testcode + extra
     seed = stable_seed(test_fingerprint, student_code)
+    marcar_fase("stable_seed")
 
-    # Barajar entradas UNA VEZ
-    barajar_entradas_con_seed(attach_list, seed)
+    # Barajar entradas UNA VEZ, en la instantánea del sandbox
+    instantanea = crear_instantanea(attach_list, seed)
+    marcar_fase("barajar")
 
-    # Leer entradas reales
-    inputs_dict = {fn: read_text_file(fn) for fn in attach_list}
+    clave = clave_patron(answer, (stdin, testcode, extra), attach_list, instantanea["dir"])
+    cacheado = patron_desde_cache(clave)
+    marcar_fase("cache_patron")
 
-    # ---------------- PATRÓN ----------------
-    expected_stdout = ""
-    expected_files_bytes = {}
-    expected_files_text = {}
+    dir_patron = directorio_sandbox("patron")
+    dir_alumno = directorio_sandbox("alumno")
+    if cacheado is None:
+        restaurar_sandbox(dir_patron, instantanea)
+    restaurar_sandbox(dir_alumno, instantanea)
+    marcar_fase("sandbox")
 
-    answer = """{{ QUESTION.answer | e('py') }}"""
-    for fn in outfiles:
-        delete_if_exists(fn)
+    # ---------------- PATRÓN ----------------
+    # Sin caché el patrón se ejecuta antes que el alumno: los límites del
+    # alumno salen siempre del coste del patrón, esté o no en la caché, y el
+    # mismo envío recibe la misma nota en frío y en caliente
+    if cacheado is not None:
+        expected_stdout, expected_files, coste_patron = cacheado
+    else:
+        patron_job = {"code": answer, "stdin": stdin, "cwd": dir_patron, "precompilar": True}
+        (exp_r,) = ejecutar_varios([patron_job])
+        marcar_fase("ejecucion")
+        anotar_estabilidad(exp_r)
+        anotar_fase("patron", exp_r["tiempo"])
+        anotar_recursos("patron", exp_r)
+        anotar_metricas("patron", exp_r)
 
-    exp_out, exp_err = run_py(BARAJAR_SRC + answer, stdin)
-    if exp_err:
-        print(json.dumps({"expected": "", "got": block("Error en patrón", exp_err), "fraction": 0}))
-        return
+        exp_out, exp_err = resultado_run_py(exp_r)
+        if exp_err:
+            return {"expected": "", "got": block("Error en patrón", exp_err), "fraction": 0}
 
-    expected_stdout = exp_out
-    for fn in outfiles:
-        expected_files_bytes[fn] = read_file_bytes(fn)
-        expected_files_text[fn] = read_text_file(fn)
-
-    expected_html = construir_html(
-        "PATRÓN",
-        testcode,
-        stdin,
-        inputs_dict,
-        expected_stdout,
-        expected_files_text
-    )
+        expected_stdout = exp_out
+        expected_files = {fn: capturar_fichero(os.path.join(dir_patron, fn)) for fn in outfiles}
+        coste_patron = coste(exp_r)
+        patron_a_cache(clave, expected_stdout, expected_files, coste_patron)
+    marcar_fase("salida_patron")
 
-    for fn in outfiles:
-        delete_if_exists(fn)
+    # Con PARADA_TEMPRANA el alumno se para en la primera diferencia con la
+    # salida del patrón
+    alumno_job = {
+        "code": student_code + "\n" + testcode,
+        "stdin": stdin,
+        "cwd": dir_alumno,
+        "limites": limites_alumno(coste_patron),
+    }
+    if PARADA_TEMPRANA:
+        alumno_job["vigilante"] = vigilante_stdout(expected_stdout, politica)
+    (got_r,) = ejecutar_varios([alumno_job])
+    marcar_fase("ejecucion")
+    anotar_estabilidad(got_r)
+    anotar_fase("alumno", got_r["tiempo"])
+    anotar_recursos("alumno", got_r)
+    anotar_metricas("alumno", got_r)
 
     # ---------------- ALUMNO ----------------
-    got_out, got_err = run_py(BARAJAR_SRC + student_code + "\n" + testcode, stdin)
+    got_out, got_err = resultado_run_py(got_r)
     got_stdout = got_out + (("\n" + got_err) if got_err else "")
 
-    got_files_text = {fn: read_text_file(fn) for fn in outfiles}
+    # Cada fichero del alumno se lee una vez: se compara con el del patrón
+    # (o con su sha256 si viene de la caché) mientras se saca la vista previa
+    got_files = {}
+    for fn in outfiles:
+        esperado = expected_files[fn] if cacheado is not None else os.path.join(dir_patron, fn)
+        got_files[fn] = capturar_fichero(os.path.join(dir_alumno, fn), esperado)
+    marcar_fase("salida_alumno")
 
-    got_html = construir_html(
-        "ALUMNO",
-        testcode,
-        stdin,
-        inputs_dict,
-        got_stdout,
-        got_files_text
+    # ---------------- COMPARACIÓN ----------------
+    ok_stdout = (
+        not got_r["divergencia"]
+        and comparacion["igual"](expected_stdout, got_stdout)
     )
 
-    # ---------------- COMPARACIÓN ----------------
-    ok_stdout = normalize_stdout(got_stdout) == normalize_stdout(expected_stdout)
-
-    ok_files = True
-    for fn in outfiles:
-        if read_file_bytes(fn) != expected_files_bytes.get(fn):
-            ok_files = False
-            break
+    ok_files = all(f["igual"] for f in got_files.values())
 
     fraction = 1 if (ok_stdout and ok_files) else 0
+    marcar_fase("comparacion")
+
+    # ---------------- HTML ----------------
+    # El contexto del test solo va en la mitad del patrón. Del alumno se
+    # muestra su resultado solo si ha fallado, con el diff de stdout.
+    inputs_dict = {fn: read_text_file(os.path.join(instantanea["dir"], fn)) for fn in attach_list}
+    expected_html = "\n".join([
+        "<h3>PATRÓN</h3>",
+        html_contexto(testcode, stdin, inputs_dict),
+        html_resultado(expected_stdout, {fn: f["texto"] for fn, f in expected_files.items()}),
+    ]).rstrip()
+
+    if fraction == 1:
+        got_html = "<h3>ALUMNO</h3>\n<p>El resultado coincide con el del patrón.</p>"
+    else:
+        partes = ["<h3>ALUMNO</h3>"]
+        if got_r["divergencia"]:
+            partes.append(bloque_divergencia(got_r["divergencia"]))
+        elif not ok_stdout and comparacion["diff"]:
+            partes.append(bloque_diferencias(expected_stdout, got_stdout))
+        partes.append(html_resultado(got_stdout, {fn: f["texto"] for fn, f in got_files.items()}))
+        got_html = "\n".join(p for p in partes if p).rstrip()
+    marcar_fase("construir_html")
 
-    print(json.dumps({
+    return {
         "expected": expected_html,
         "got": got_html,
         "fraction": fraction
-    }))
+    }
+
+def do_testing():
+    stdin = """{{ TEST.stdin | e('py') }}"""
+    testcode = """{{ TEST.testcode | e('py') }}"""
+    extra = """{{ TEST.extra | e('py') }}"""
+
+    attach_list, student_code, answer = datos_pregunta()
+    clave = clave_veredicto("do_testing", (stdin, testcode, extra), attach_list, student_code, answer)
+    salida = veredicto_desde_cache(clave)
+    if salida is None:
+        reiniciar_presupuesto_html()
+        salida = json.dumps(evaluar_test(stdin, testcode, extra, attach_list, student_code, answer))
+        veredicto_a_cache(clave, salida)
+    print(salida)
+
+# =========================================================
+# TODOS LOS TESTS EN UNA INVOCACIÓN (combinator)
+# =========================================================
+
+def test_oculto(test, correcto):
+    display = (test.get("display") or "SHOW").upper()
+    return (
+        display == "HIDE"
+        or (display == "HIDE_IF_FAIL" and not correcto)
+        or (display == "HIDE_IF_SUCCEED" and correcto)
+    )
+
+def do_testing_combinator(parar_en_fallo=False):
+    tests = json.loads("""{{ TESTCASES | json_encode | e('py') }}""")
+    attach_list, student_code, answer = datos_pregunta()
+    clave = clave_veredicto(
+        f"do_testing_combinator({parar_en_fallo})", (json.dumps(tests, sort_keys=True),),
+        attach_list, student_code, answer,
+    )
+    salida = veredicto_desde_cache(clave)
+    if salida is None:
+        salida = json.dumps(evaluar_tests(tests, attach_list, student_code, answer, parar_en_fallo))
+        veredicto_a_cache(clave, salida)
+    print(salida)
+
+def evaluar_tests(tests, attach_list, student_code, answer, parar_en_fallo=False):
+    # Resultado del combinator para todos los TESTS
+    reiniciar_presupuesto_html()
+
+    filas = [["iscorrect", "ishidden", "Esperado", "Obtenido"]]
+    puntos = 0.0
+    total = 0.0
+    parado = False
+
+    for test in tests:
+        mark = float(test.get("mark") or 1)
+        total += mark
+
+        if parado:
+            filas.append([0, test_oculto(test, False), "",
+                          "<i>No ejecutado: la evaluación se detuvo en un test fallido.</i>"])
+            continue
+
+        r = evaluar_test(
+            test.get("stdin") or "",
+            test.get("testcode") or "",
+            test.get("extra") or "",
+            attach_list, student_code, answer
+        )
+        correcto = r["fraction"] == 1
+        puntos += mark * r["fraction"]
+        filas.append([int(correcto), test_oculto(test, correcto), r["expected"], r["got"]])
+
+        if not correcto and (parar_en_fallo or test.get("hiderestiffail")):
+            parado = True
+
+    return {
+        "fraction": puntos / total if total else 0,
+        "testresults": filas,
+        "columnformats": ["%h", "%h"]
+    }
@@ -0,0 +1,447 @@
+"""
+Recalificación masiva de envíos fuera de Moodle.
+
+Uso:
+    python recalificar.py preguntas.jsonl envios.jsonl -o resultados.jsonl
+                          [-j 4] [--motor plantilla|libreria] [--tiempo 120]
+                          [--memoria MiB] [--solo-nota] [--desde-cero]
+
+preguntas.jsonl, una pregunta por línea:
+    {"id": ..., "answer": "código del patrón", "parameters": {...},
+     "tests": [{"stdin": ..., "testcode": ..., "extra": ..., "mark": ...}],
+     "adjuntos": {"nombre": "contenido"}, "motor": "plantilla" | "libreria"}
+
+envios.jsonl, un envío por línea:
+    {"id": ..., "pregunta": <id de la pregunta>, "respuesta": "código del alumno"}
+
+resultados.jsonl, una línea por envío en el orden en que terminan:
+    {"id", "pregunta", "estado": "ok" | "error" | "tiempo", "fraction",
+     "segundos", "resultado" (el JSON de la plantilla) o "error"}
+
+Con el motor "plantilla" cada envío se corrige con plantilla.py renderizada
+(do_testing_combinator, con todos los tests) en un proceso propio; con
+"libreria", con el pipeline de libreria.py en un hijo del trabajador (en
+las preguntas de tipo función con "semilla", los resultados del patrón se
+calculan una sola vez por trabajador). Los envíos se reparten entre J procesos y cada uno tiene un límite de tiempo
+(--tiempo, al agotarlo se mata el proceso que lo corrige) y, opcionalmente,
+de memoria (--memoria, para todo el trabajador).
+
+El fichero de resultados es también el punto de control: cada resultado se
+escribe en cuanto termina y, al volver a lanzar la orden, se saltan los
+envíos que ya tienen uno (--desde-cero para empezar de nuevo).
+"""
+import argparse, json, marshal, os, select, shutil, signal, subprocess, sys, tempfile, time
+import resource
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import comun
+import libreria
+
+MOTORES = ("plantilla", "libreria")
+# Veces que se reintenta un envío cuando se cae el proceso que lo corregía
+MAX_INTENTOS = 2
+# Cada cuántos segundos se informa del progreso
+INTERVALO_PROGRESO = 5.0
+
+
+# ╔════════════ FICHEROS JSONL ═════════════════════════════════╗
+
+def leer_jsonl(ruta):
+    """
+    Devuelve los objetos de RUTA uno a uno. Las líneas vacías o que no son
+    JSON (p. ej. la última, si se cortó una ejecución anterior) se saltan.
+    """
+    with open(ruta, encoding="utf8") as f:
+        for num, linea in enumerate(f, 1):
+            if not linea.strip():
+                continue
+            try:
+                yield json.loads(linea)
+            except ValueError:
+                print(f"{ruta}:{num}: línea no válida, se ignora", file=sys.stderr)
+
+
+def recortar_linea_incompleta(ruta):
+    """
+    Quita de RUTA lo que haya tras el último salto de línea (una línea a
+    medio escribir cuando se cortó una ejecución anterior), para que lo que
+    se añada después empiece en una línea nueva.
+    """
+    if not os.path.exists(ruta):
+        return
+    with open(ruta, "rb+") as f:
+        fin = f.seek(0, os.SEEK_END)
+        pos = fin
+        while pos > 0:
+            inicio = max(0, pos - 65536)
+            f.seek(inicio)
+            bloque = f.read(pos - inicio)
+            salto = bloque.rfind(b"\n")
+            if salto != -1:
+                pos = inicio + salto + 1
+                break
+            pos = inicio
+        if pos != fin:
+            f.truncate(pos)
+
+
+def ids_hechos(ruta):
+    """Ids de los envíos que ya tienen resultado en RUTA (vacío si no existe)."""
+    if not os.path.exists(ruta):
+        return set()
+    return {r.get("id") for r in leer_jsonl(ruta)}
+
+
+# ╔════════════ TRABAJADORES ═══════════════════════════════════╗
+
+# Estado de cada proceso trabajador (lo rellena _iniciar_trabajador)
+_preguntas = {}
+_opciones = {}
+_adjuntos = {}
+_memo_calentado = set()
+_fuente = None
+
+
+def _iniciar_trabajador(ruta_preguntas, opciones):
+    global _fuente
+    _preguntas.update((p.get("id"), p) for p in leer_jsonl(ruta_preguntas))
+    _opciones.update(opciones)
+    with open(os.path.join(comun.RAIZ, "plantilla.py"), encoding="utf8") as f:
+        _fuente = f.read()
+    if opciones.get("memoria"):
+        limite = opciones["memoria"] * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+    # Ctrl+C lo gestiona el proceso principal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _directorio_adjuntos(pregunta):
+    """
+    Directorio con los adjuntos de PREGUNTA, escrito una sola vez por
+    trabajador. Los ficheros quedan de solo lectura porque se enlazan (no
+    se copian) en el directorio de cada envío.
+    """
+    pid = pregunta.get("id")
+    if pid not in _adjuntos:
+        directorio = tempfile.mkdtemp(prefix="adjuntos_", dir=_opciones["temporal"])
+        for nombre, contenido in pregunta.get("adjuntos", {}).items():
+            ruta = os.path.join(directorio, nombre)
+            with open(ruta, "w", encoding="utf8") as f:
+                f.write(contenido)
+            os.chmod(ruta, 0o444)
+        _adjuntos[pid] = directorio
+    return _adjuntos[pid]
+
+
+def _enlazar_adjuntos(pregunta, destino):
+    origen = _directorio_adjuntos(pregunta)
+    for nombre in pregunta.get("adjuntos", {}):
+        try:
+            os.link(os.path.join(origen, nombre), os.path.join(destino, nombre))
+        except OSError:
+            shutil.copyfile(os.path.join(origen, nombre), os.path.join(destino, nombre))
+
+
+def _recalificar_plantilla(pregunta, envio, tiempo):
+    valores = {
+        "ATTACHMENTS": ",".join(pregunta.get("adjuntos", {})),
+        "STUDENT_ANSWER": envio.get("respuesta", ""),
+        "QUESTION.answer": pregunta.get("answer", ""),
+        "QUESTION.parameters": pregunta.get("parameters", {}),
+        "TESTCASES": pregunta.get("tests", []),
+    }
+    with tempfile.TemporaryDirectory(prefix="recalificar_") as d:
+        _enlazar_adjuntos(pregunta, d)
+        with open(os.path.join(d, "prog.py"), "w", encoding="utf8") as f:
+            f.write(comun.renderizar_plantilla(valores, "do_testing_combinator()", _fuente))
+        # Sesión propia: al agotar el tiempo se mata también a los hijos de la plantilla
+        p = subprocess.Popen(
+            [sys.executable, "prog.py"], cwd=d, start_new_session=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        try:
+            salida, errores = p.communicate(timeout=tiempo)
+        except subprocess.TimeoutExpired:
+            os.killpg(p.pid, signal.SIGKILL)
+            p.communicate()
+            return {"estado": "tiempo", "fraction": 0.0, "error": f"más de {tiempo} s"}
+
+    lineas = salida.decode("utf8", errors="replace").strip().splitlines()
+    try:
+        resultado = json.loads(lineas[-1])
+    except (IndexError, ValueError):
+        error = errores.decode("utf8", errors="replace").strip()[-2000:]
+        return {"estado": "error", "fraction": 0.0, "error": error or f"código de salida {p.returncode}"}
+    return {"estado": "ok", "fraction": resultado.get("fraction", 0.0), "resultado": resultado}
+
+
+def _en_hijo(funcion, tiempo):
+    """
+    Ejecuta FUNCION() (que devuelve bytes) en un hijo con su propio grupo de
+    procesos, que se mata con todo lo que haya lanzado a los TIEMPO segundos.
+    Devuelve (los bytes, o None si se agotó el tiempo; código de salida).
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        estado = 1
+        try:
+            os.close(r)
+            os.setsid()
+            with os.fdopen(w, "wb") as f:
+                f.write(funcion())
+            estado = 0
+        finally:
+            os._exit(estado)
+    os.close(w)
+
+    partes = []
+    limite = time.monotonic() + tiempo
+    agotado = False
+    try:
+        while True:
+            restante = limite - time.monotonic()
+            if restante <= 0 or not select.select([r], [], [], restante)[0]:
+                agotado = True
+                break
+            datos = os.read(r, 1 << 16)
+            if not datos:
+                break
+            partes.append(datos)
+    finally:
+        os.close(r)
+        try:
+            os.killpg(pid, signal.SIGKILL)  # también lo que el alumno dejara en marcha
+        except ProcessLookupError:
+            pass
+        _, status = os.waitpid(pid, 0)
+    return (None if agotado else b"".join(partes)), os.waitstatus_to_exitcode(status)
+
+
+def _recalificar_libreria(pregunta, envio, tiempo):
+    # El pipeline ejecuta el código del alumno dentro del proceso: se corre en
+    # un hijo que se mata al agotar el tiempo, porque una alarma la puede
+    # capturar el alumno y un bucle en C no la atiende
+    _calentar_memo(pregunta, tiempo)
+    datos, codigo = _en_hijo(lambda: json.dumps(_evaluar_libreria(pregunta, envio)).encode("utf8"), tiempo)
+    if datos is None:
+        return {"estado": "tiempo", "fraction": 0.0, "error": f"más de {tiempo} s"}
+    try:
+        return json.loads(datos)
+    except ValueError:
+        return {"estado": "error", "fraction": 0.0,
+                "error": f"el proceso que corregía terminó con estado {codigo}"}
+
+
+def _calentar_memo(pregunta, tiempo):
+    """
+    Llena el memo de resultados del patrón del trabajador con los casos de
+    PREGUNTA, una vez por pregunta, para que los hijos de los envíos lo
+    hereden y no repitan esas llamadas. Se calcula en un hijo que solo
+    ejecuta el patrón: del hijo de un envío, que ejecuta código del alumno,
+    no se recoge nunca nada. Solo sirve si la pregunta fija "semilla" (si
+    no, cada envío genera casos distintos).
+    """
+    parametros = pregunta.get("parameters", {})
+    pid = pregunta.get("id")
+    if pid in _memo_calentado or parametros.get("tipo") != "funcion" or parametros.get("semilla") is None:
+        return
+    _memo_calentado.add(pid)
+    datos, _ = _en_hijo(lambda: marshal.dumps(_resultados_patron(pregunta)), tiempo)
+    if datos:
+        try:
+            libreria.anadir_memo_patron(marshal.loads(datos))
+        except (ValueError, EOFError, TypeError):
+            pass
+
+
+def _resultados_patron(pregunta):
+    # Las mismas etapas que evaluar_funcion hasta generar los casos; después,
+    # solo las llamadas al patrón
+    contexto = libreria.cargar_parametros(libreria.Contexto(), json.dumps(pregunta.get("parameters", {})))
+    contexto = libreria.preparar_contexto(contexto)
+    patron = {}
+    exec(pregunta.get("answer", ""), patron)
+    f_pat = patron.get(contexto.get("nombre_funcion_patron"))
+    huella = libreria.huella_funcion(f_pat) if f_pat is not None else None
+    if huella:
+        for args in contexto.get("casos_argumentos") or [contexto.get("argumentos", [])]:
+            libreria.resultado_patron(f_pat, args, huella)
+    return libreria.entradas_memo_patron()
+
+
+def _evaluar_libreria(pregunta, envio):
+    caso = {
+        "parametros": pregunta.get("parameters", {}),
+        "patron": pregunta.get("answer", ""),
+        "alumno": envio.get("respuesta", ""),
+    }
+    try:
+        contexto = comun.evaluar_con_pipeline(caso, directorio_propio=True)
+        resultado = json.loads(contexto.get("resultado") or "null")
+    except BaseException as e:  # también SystemExit del código del alumno
+        return {"estado": "error", "fraction": 0.0, "error": f"{type(e).__name__}: {e}"}
+    return {"estado": "ok", "fraction": contexto.get("award", 0.0), "resultado": resultado}
+
+
+def recalificar_envio(envio):
+    """
+    Corrige ENVIO con el motor de su pregunta. Se ejecuta en un trabajador
+    y devuelve la línea de resultados (nunca lanza excepciones).
+    """
+    t0 = time.perf_counter()
+    pregunta = _preguntas.get(envio.get("pregunta"))
+    try:
+        if pregunta is None:
+            r = {"estado": "error", "fraction": 0.0, "error": f"no existe la pregunta {envio.get('pregunta')!r}"}
+        elif pregunta.get("motor", _opciones["motor"]) == "libreria":
+            r = _recalificar_libreria(pregunta, envio, _opciones["tiempo"])
+        else:
+            r = _recalificar_plantilla(pregunta, envio, _opciones["tiempo"])
+    except Exception as e:
+        r = {"estado": "error", "fraction": 0.0, "error": f"{type(e).__name__}: {e}"}
+    if _opciones.get("solo_nota"):
+        r.pop("resultado", None)
+    return dict({"id": envio.get("id"), "pregunta": envio.get("pregunta")},
+                segundos=round(time.perf_counter() - t0, 4), **r)
+
+
+# ╔════════════ PLANIFICADOR ═══════════════════════════════════╗
+
+class Progreso:
+    """Cuenta los envíos terminados y muestra el ritmo por stderr."""
+
+    def __init__(self, total):
+        self.total = total
+        self.estados = {}
+        self.tiempos = []
+        self.suma_notas = 0.0
+        self.inicio = time.perf_counter()
+        self.ultimo = self.inicio
+
+    def anotar(self, resultado):
+        self.estados[resultado["estado"]] = self.estados.get(resultado["estado"], 0) + 1
+        self.tiempos.append(resultado["segundos"])
+        self.suma_notas += resultado.get("fraction") or 0.0
+        if time.perf_counter() - self.ultimo >= INTERVALO_PROGRESO:
+            self.mostrar()
+
+    def mostrar(self, final=False):
+        self.ultimo = time.perf_counter()
+        hechos = len(self.tiempos)
+        ritmo = hechos / max(self.ultimo - self.inicio, 1e-9)
+        quedan = (self.total - hechos) / ritmo if ritmo else 0.0
+        estados = " ".join(f"{k}={v}" for k, v in sorted(self.estados.items()))
+        linea = (
+            f"{hechos}/{self.total}  {ritmo:6.2f} env/s  {estados}"
+            f"  nota media {self.suma_notas / hechos if hechos else 0:.3f}"
+        )
+        if final:
+            ms = [t * 1000 for t in self.tiempos]
+            linea += (
+                f"  p50 {comun.percentil(ms, 50):.0f} ms  p95 {comun.percentil(ms, 95):.0f} ms"
+                f"  total {self.ultimo - self.inicio:.1f} s"
+            )
+        else:
+            linea += f"  quedan ~{quedan:.0f} s"
+        print(linea, file=sys.stderr, flush=True)
+
+
+def recalificar(args):
+    if args.desde_cero and os.path.exists(args.salida):
+        os.remove(args.salida)
+    recortar_linea_incompleta(args.salida)
+    hechos = ids_hechos(args.salida)
+    pendientes = (e for e in leer_jsonl(args.envios) if e.get("id") not in hechos)
+    total = sum(1 for e in leer_jsonl(args.envios) if e.get("id") not in hechos)
+    if hechos:
+        print(f"Se reanuda: {len(hechos)} envíos ya corregidos", file=sys.stderr)
+
+    # Los trabajadores dejan los adjuntos aquí y se borra todo al final
+    temporal = tempfile.TemporaryDirectory(prefix="recalificar_")
+    opciones = {
+        "motor": args.motor, "tiempo": args.tiempo, "memoria": args.memoria,
+        "solo_nota": args.solo_nota, "temporal": temporal.name,
+    }
+
+    def nuevo_pool():
+        return ProcessPoolExecutor(
+            max_workers=args.j, initializer=_iniciar_trabajador,
+            initargs=(args.preguntas, opciones),
+        )
+
+    progreso = Progreso(total)
+    pool = nuevo_pool()
+    en_curso = {}  # future -> (envío, intentos)
+    reintentos = []
+    try:
+        with open(args.salida, "a", encoding="utf8") as salida:
+            while True:
+                # Como mucho 2*J envíos encargados: envios.jsonl no se carga entero
+                while len(en_curso) < 2 * args.j:
+                    if reintentos:
+                        envio, intentos = reintentos.pop()
+                    else:
+                        envio, intentos = next(pendientes, None), 0
+                        if envio is None:
+                            break
+                    en_curso[pool.submit(recalificar_envio, envio)] = (envio, intentos)
+                if not en_curso:
+                    break
+
+                listos, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+                roto = False
+                for futuro in listos:
+                    envio, intentos = en_curso.pop(futuro)
+                    try:
+                        resultado = futuro.result()
+                    except BrokenProcessPool:
+                        # Un trabajador murió (p. ej. por memoria): se repite el envío
+                        roto = True
+                        if intentos + 1 < MAX_INTENTOS:
+                            reintentos.append((envio, intentos + 1))
+                            continue
+                        resultado = {
+                            "id": envio.get("id"), "pregunta": envio.get("pregunta"), "segundos": 0.0,
+                            "estado": "error", "fraction": 0.0, "error": "el proceso trabajador terminó de forma inesperada",
+                        }
+                    salida.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+                    salida.flush()
+                    progreso.anotar(resultado)
+                if roto:
+                    # El resto de lo encargado también se ha perdido con el pool
+                    reintentos.extend(en_curso.values())
+                    en_curso.clear()
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    pool = nuevo_pool()
+    except KeyboardInterrupt:
+        print("Interrumpido: se puede reanudar con la misma orden", file=sys.stderr)
+        pool.shutdown(wait=False, cancel_futures=True)
+        sys.exit(130)
+    finally:
+        pool.shutdown()
+        temporal.cleanup()
+    progreso.mostrar(final=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("preguntas", help="JSONL con las preguntas")
+    parser.add_argument("envios", help="JSONL con los envíos")
+    parser.add_argument("-o", "--salida", required=True, help="JSONL de resultados (y punto de control)")
+    parser.add_argument("-j", type=int, default=os.cpu_count() or 1, help="procesos trabajadores")
+    parser.add_argument("--motor", choices=MOTORES, default="plantilla",
+                        help="motor de las preguntas que no indican uno")
+    parser.add_argument("--tiempo", type=float, default=120, help="segundos como máximo por envío")
+    parser.add_argument("--memoria", type=int, help="MiB como máximo por trabajador")
+    parser.add_argument("--solo-nota", action="store_true", help="no guardar el JSON completo de cada resultado")
+    parser.add_argument("--desde-cero", action="store_true", help="ignorar los resultados de una ejecución anterior")
+    args = parser.parse_args(argv)
+    recalificar(args)
+
+
+if __name__ == "__main__":
+    main()